@@ -0,0 +1,123 @@
+import py2snes
+from py2snes.mockserver import mockserver
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+async def bench_reads(snes, count):
+    start = time.perf_counter()
+    for idx in range(count):
+        await snes.GetAddress(py2snes.WRAM_START + idx * 16, 16)
+    return count / (time.perf_counter() - start)
+
+async def bench_pipelined_reads(snes, count):
+    start = time.perf_counter()
+    await asyncio.gather(*[snes.GetAddress(py2snes.WRAM_START + idx * 16, 16) for idx in range(count)])
+    return count / (time.perf_counter() - start)
+
+async def bench_scattered_reads(snes, count):
+    regions = [(py2snes.WRAM_START + idx * 0x400, 2) for idx in range(30)]
+    start = time.perf_counter()
+    for idx in range(count):
+        await snes.GetAddresses(regions)
+    return count / (time.perf_counter() - start)
+
+async def bench_read_throughput(snes, size):
+    start = time.perf_counter()
+    await snes.GetAddress(py2snes.ROM_START, size)
+    return size / (time.perf_counter() - start)
+
+async def bench_write_throughput(snes, size):
+    start = time.perf_counter()
+    await snes.PutAddress([(py2snes.WRAM_START, bytes(size))])
+    # a following read only completes once the writes were handled
+    await snes.GetAddress(py2snes.WRAM_START, 1)
+    return size / (time.perf_counter() - start)
+
+async def bench_putfile(snes, size):
+    fd, path = tempfile.mkstemp(suffix='.sfc')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(os.urandom(size))
+        start = time.perf_counter()
+        await snes.PutFile(path, '/benchmark.sfc')
+        return size / (time.perf_counter() - start)
+    finally:
+        os.remove(path)
+
+async def bench_jitter(snes, rate, seconds):
+    interval = 1 / rate
+    lateness = []
+    start = time.perf_counter()
+    due = start
+    while due - start < seconds:
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        lateness.append(time.perf_counter() - due)
+        await snes.GetAddress(py2snes.WRAM_START, 0x100)
+        due += interval
+    return statistics.pstdev(lateness) * 1000, max(lateness) * 1000
+
+async def main(args):
+    server = mockserver(latency=args.latency / 1000, frame_size=args.frame_size)
+    address = await server.start()
+
+    snes = py2snes.snes()
+    await snes.connect(address)
+    devices = await snes.DeviceList()
+    await snes.Attach(devices[0])
+
+    results = {}
+    results['reads/s'] = await bench_reads(snes, args.count)
+    results['pipelined reads/s'] = await bench_pipelined_reads(snes, args.count)
+    results['30-region reads/s'] = await bench_scattered_reads(snes, args.count)
+    results['GetAddress bytes/s'] = await bench_read_throughput(snes, args.size)
+    results['PutAddress bytes/s'] = await bench_write_throughput(snes, 0x2000)
+    results['PutFile bytes/s'] = await bench_putfile(snes, args.size)
+    results['jitter stdev ms'], results['jitter max ms'] = await bench_jitter(snes, 60, args.seconds)
+
+    await snes.close()
+    await server.stop()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark py2snes against an in-process mock QUsb2snes server.')
+    parser.add_argument('--latency', type=float, default=1, help='server latency per request in ms')
+    parser.add_argument('--frame-size', type=int, default=1024, help='largest binary frame the server sends')
+    parser.add_argument('--count', type=int, default=500, help='number of requests for the request rate benchmarks')
+    parser.add_argument('--size', type=int, default=4*1024*1024, help='bytes transferred by the throughput benchmarks')
+    parser.add_argument('--seconds', type=float, default=2, help='duration of the polling jitter benchmark')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='compare with results saved by --json and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression when comparing, as a fraction')
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+    for name, value in results.items():
+        print("{name:>20}: {value:,.2f}".format(name=name, value=value))
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)
+        regressions = []
+        for name, value in results.items():
+            if name not in baseline or not baseline[name]:
+                continue
+            # rates should not drop, jitter should not grow
+            change = (value - baseline[name]) / baseline[name]
+            if ('jitter' in name and change > args.tolerance) or ('jitter' not in name and change < -args.tolerance):
+                regressions.append(name)
+            print("{name:>20}: {change:+.1%}".format(name=name, change=change))
+        if regressions:
+            print('Regressions: %s' % ', '.join(regressions))
+            sys.exit(1)
@@ -1,14 +1,29 @@
 __version__ = '1.0.4'
 
-import websockets
-import json
-from pathlib import Path
-
-import asyncio
-import aiofiles
+import bisect
+import collections
+import importlib
 import os
+import time
+
+class _lazymodule():
+    """A module imported on first use, so command line tools that never connect do not pay for it."""
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self._name), attr)
+        # later lookups find it without coming back here
+        setattr(self, attr, value)
+        return value
 
-import logging
+asyncio = _lazymodule('asyncio')
+aiofiles = _lazymodule('aiofiles')
+json = _lazymodule('json')
+logging = _lazymodule('logging')
+websockets = _lazymodule('websockets')
+
+from py2snes.metrics import metrics
 
 class usb2snesException(Exception):
     pass
@@ -23,26 +38,117 @@ WRAM_START = 0xF50000
 WRAM_SIZE = 0x20000
 SRAM_START = 0xE00000
 
+GETADDRESS_MAX_REGIONS = 8
+PUTADDRESS_MAX_REGIONS = 8
+
+# snescmd space the SD2SNES NMI hook at $2C00 can run a WRAM write payload from
+SD2SNES_CMD_SIZE = 0x400
+# seconds to wait for the NMI hook to run a payload, and between checks that it has
+SD2SNES_PAYLOAD_TIMEOUT = 0.5
+SD2SNES_POLL_INTERVAL = 1/60
+
+LIST_CACHE_TTL = 30
+
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+# how long idempotent reads wait for the connection to come back
+RECONNECT_TIMEOUT = 30
+
+# how long a GetFileStream consumer may leave its buffer full before the rest of the file is thrown away
+STREAM_STALL_TIMEOUT = 2
+
+PUTFILE_CHUNK_SIZE = 4096
+# slowest SD card write rate PutFile waits for before giving up on the upload
+PUTFILE_MIN_RATE = 64 * 1024
+
+class _stream():
+    def __init__(self, maxsize):
+        self.queue = asyncio.Queue(maxsize)
+        self.error = None
+        self.discard = False
+
+class _pending():
+    def __init__(self, opcode, size=None, buffer=None, stream=None):
+        self.opcode = opcode
+        self.size = size # None for a JSON reply, otherwise the number of bytes expected
+        self.received = 0
+        self.stream = stream
+        self.sent = None
+        self.bytes_out = 0
+        self.lock_wait = 0
+        self.depth = 0
+        if size is not None:
+            # binary replies are copied once, straight into their final buffer
+            self.buffer = bytearray(size) if buffer is None else buffer
+            self.view = memoryview(self.buffer).cast('B')
+        self.future = asyncio.get_event_loop().create_future()
+
+class _poller():
+    """Runs self.run() as a task from start() until stop(), for the pollers built on a snes."""
+    task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
 class snes():
-    def __init__(self):
+    def __init__(self, max_inflight=8, reconnect=False):
         self.socket = None
-        self.recv_queue = asyncio.Queue()
-        self.request_lock = asyncio.Lock()
+        self.recv_task = None
+        self.state = SNES_DISCONNECTED
+        self.address = None
+        self.write_limit = None
+        self.device = None
+        self.name = None
+        self.pending = collections.deque()
+        self.send_lock = asyncio.Lock()
+        self.inflight = asyncio.Semaphore(max_inflight)
         self.is_sd2snes = False
-        # self.attached = False
-
-    async def connect(self, address='ws://localhost:8080'):
+        self.multi_getaddress = True
+        self.abandoned = None
+        # PutAddress has no reply to tell whether the server takes several
+        # regions per request, so packing them is opt-in
+        self.multi_putaddress = False
+        self.metrics = metrics()
+        self.dircache = {}
+        self.dircache_ttl = LIST_CACHE_TTL
+        self.attached = asyncio.Event()
+
+        # with reconnect, a dropped connection is reopened with exponential
+        # backoff, re-attached to the same device and idempotent reads retried
+        self.reconnect = reconnect
+        self.reconnect_delay = RECONNECT_DELAY
+        self.reconnect_max_delay = RECONNECT_MAX_DELAY
+        self.reconnect_timeout = RECONNECT_TIMEOUT
+        self.reconnect_task = None
+        self.reconnects = 0
+        self.downtime = 0
+        self.closing = False
+
+    async def connect(self, address='ws://localhost:8080', write_limit=2**16):
         if self.socket is not None:
             print('Already connected to snes')
             return
 
         self.state = SNES_CONNECTING
-        recv_task = None
+        self.address = address
+        self.write_limit = write_limit
+        self.closing = False
 
         print("Connecting to QUsb2snes at %s ..." % address)
 
         try:
-            self.socket = await websockets.connect(address, ping_timeout=None, ping_interval=None)
+            self.socket = await websockets.connect(address, ping_timeout=None, ping_interval=None, write_limit=write_limit)
             self.state = SNES_CONNECTED
         except Exception as e:
             if self.socket is not None:
@@ -50,12 +156,91 @@ class snes():
                     await self.socket.close()
                 self.socket = None
             self.state = SNES_DISCONNECTED
+            return
 
         self.recv_task = asyncio.create_task(self.recv_loop())
 
-    async def DeviceList(self):
-        await self.request_lock.acquire()
+    async def close(self):
+        self.closing = True
+        if self.reconnect_task is not None and self.reconnect_task is not asyncio.current_task():
+            self.reconnect_task.cancel()
+        socket = self.socket
+        if socket is not None and not socket.closed:
+            await socket.close()
+        if self.recv_task is not None:
+            await self.recv_task
+
+    async def _reconnect(self):
+        disconnected = time.monotonic()
+        delay = self.reconnect_delay
+        try:
+            while not self.closing:
+                if await self._reopen():
+                    break
+
+                socket = self.socket
+                if socket is not None and not socket.closed:
+                    await socket.close()
+                print("Reconnecting to QUsb2snes in %g seconds ..." % delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max_delay)
+            else:
+                return
+
+            self.reconnects += 1
+            self.downtime += time.monotonic() - disconnected
+        finally:
+            self.reconnect_task = None
+
+    async def _reopen(self):
+        """Connect to the same address again and attach to the same device, returning whether that worked."""
+        await self.connect(self.address, self.write_limit)
+        if self.state != SNES_CONNECTED:
+            return False
+        if self.device is None:
+            return True
+        devices = await self.DeviceList()
+        if devices and self.device in devices:
+            await self.Attach(self.device)
+            if self.state == SNES_ATTACHED:
+                if self.name is not None:
+                    await self.Name(self.name)
+                return True
+        return False
+
+    def snapshot(self):
+        """Return the request metrics along with the current queue depth, state and reconnect counters."""
+        snapshot = self.metrics.snapshot()
+        snapshot.update({
+            "pending": len(self.pending),
+            "state": self.state,
+            "reconnects": self.reconnects,
+            "downtime": self.downtime,
+        })
+        return snapshot
+
+    async def _reattached(self):
+        if self.state == SNES_ATTACHED and self.socket is not None:
+            return True
+        if not self.reconnect or self.closing or self.device is None:
+            return False
+        try:
+            await asyncio.wait_for(self.attached.wait(), self.reconnect_timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self.state == SNES_ATTACHED
+
+    async def _retry(self, read):
+        """Run an idempotent read, waiting for a reconnect and running it again when the connection drops."""
+        for attempt in range(3):
+            if not await self._reattached():
+                return None
+            result = await read()
+            if result is not None or not self.reconnect or self.state == SNES_ATTACHED:
+                return result
+        return None
 
+    async def DeviceList(self):
         if self.state < SNES_CONNECTED or self.socket is None or not self.socket.open or self.socket.closed:
             return None
         try:
@@ -63,9 +248,7 @@ class snes():
                 "Opcode" : "DeviceList",
                 "Space" : "SNES",
             }
-            await self.socket.send(json.dumps(request))
-
-            reply = json.loads(await asyncio.wait_for(self.recv_queue.get(), 5))
+            reply = await asyncio.wait_for(await self.submit(request), 5)
             devices = reply['Results'] if 'Results' in reply and len(reply['Results']) > 0 else None
 
             if not devices:
@@ -78,8 +261,6 @@ class snes():
                     await self.socket.close()
                 self.socket = None
             self.state = SNES_DISCONNECTED
-        finally:
-            self.request_lock.release()
 
     async def Attach(self, device):
         if self.state != SNES_CONNECTED or self.socket is None or not self.socket.open or self.socket.closed:
@@ -90,7 +271,7 @@ class snes():
                 "Space" : "SNES",
                 "Operands" : [device]
             }
-            await self.socket.send(json.dumps(request))
+            await self._send(request)
             self.state = SNES_ATTACHED
 
             if 'SD2SNES'.lower() in device.lower() or (len(device) == 4 and device[:3] == 'COM'):
@@ -99,44 +280,42 @@ class snes():
                 self.is_sd2snes = False
 
             self.device = device
+            self.attached.set()
 
         except Exception as e:
             if self.socket is not None:
                 if not self.socket.closed:
                     await self.socket.close()
                 self.socket = None
-            self.snes_state = SNES_DISCONNECTED
+            self.state = SNES_DISCONNECTED
 
     async def Info(self):
-        try:
-            await self.request_lock.acquire()
+        return await self._retry(self._info)
 
-            if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
-                return None
-            try:
-                request = {
-                    "Opcode" : "Info",
-                    "Space" : "SNES",
-                    "Operands" : [self.device]
-                }
-                await self.socket.send(json.dumps(request))
-                reply = json.loads(await asyncio.wait_for(self.recv_queue.get(), 5))
-                info = reply['Results'] if 'Results' in reply and len(reply['Results']) > 0 else None
-                return {
-                    "firmwareversion": _listitem(info,0),
-                    "versionstring": _listitem(info,1),
-                    "romrunning": _listitem(info,2),
-                    "flag1": _listitem(info,3),
-                    "flag2": _listitem(info,4),
-                }
-            except Exception as e:
-                if self.socket is not None:
-                    if not self.socket.closed:
-                        await self.socket.close()
-                    self.socket = None
-                self.snes_state = SNES_DISCONNECTED
-        finally:
-            self.request_lock.release()
+    async def _info(self):
+        if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
+            return None
+        try:
+            request = {
+                "Opcode" : "Info",
+                "Space" : "SNES",
+                "Operands" : [self.device]
+            }
+            reply = await asyncio.wait_for(await self.submit(request), 5)
+            info = reply['Results'] if 'Results' in reply and len(reply['Results']) > 0 else None
+            return {
+                "firmwareversion": _listitem(info,0),
+                "versionstring": _listitem(info,1),
+                "romrunning": _listitem(info,2),
+                "flag1": _listitem(info,3),
+                "flag2": _listitem(info,4),
+            }
+        except Exception as e:
+            if self.socket is not None:
+                if not self.socket.closed:
+                    await self.socket.close()
+                self.socket = None
+            self.state = SNES_DISCONNECTED
 
     async def Name(self, name):
         if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
@@ -147,7 +326,8 @@ class snes():
                 "Space" : "SNES",
                 "Operands" : [name]
             }
-            await self.socket.send(json.dumps(request))
+            await self._send(request)
+            self.name = name
         except Exception as e:
             if self.socket is not None:
                 if not self.socket.closed:
@@ -164,7 +344,7 @@ class snes():
                 "Space" : "SNES",
                 "Operands" : [rom]
             }
-            await self.socket.send(json.dumps(request))
+            await self._send(request)
         except Exception as e:
             if self.socket is not None:
                 if not self.socket.closed:
@@ -181,7 +361,7 @@ class snes():
                 "Space" : "SNES",
             }
             print(json.dumps(request))
-            await self.socket.send(json.dumps(request))
+            await self._send(request)
         except Exception as e:
             if self.socket is not None:
                 if not self.socket.closed:
@@ -197,7 +377,7 @@ class snes():
                 "Opcode" : "Reset",
                 "Space" : "SNES",
             }
-            await self.socket.send(json.dumps(request))
+            await self._send(request)
         except Exception as e:
             if self.socket is not None:
                 if not self.socket.closed:
@@ -206,178 +386,506 @@ class snes():
             self.state = SNES_DISCONNECTED
 
     async def GetAddress(self, address, size):
+        data = await self.GetAddressInto(address, bytearray(size))
+        return None if data is None else bytes(data)
+
+    async def GetAddressInto(self, address, buffer):
+        """Read len(buffer) bytes at address straight into a writable buffer, returning the buffer."""
+        return await self._retry(lambda: self._getaddressinto(address, buffer))
+
+    async def _getaddressinto(self, address, buffer, space='SNES'):
+        if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
+            return None
+
+        size = memoryview(buffer).nbytes
+        GetAddress_Request = {
+            "Opcode" : "GetAddress",
+            "Space" : space,
+            "Operands" : [hex(address)[2:], hex(size)[2:]]
+        }
         try:
-            await self.request_lock.acquire()
+            future = await self.submit(GetAddress_Request, buffer=buffer)
+        except websockets.ConnectionClosed:
+            return None
 
-            if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), 5)
+        except asyncio.TimeoutError:
+            print('Error reading %s, requested %d bytes, timed out' % (hex(address), size))
+            await self._abandon(future)
+        except usb2snesException as e:
+            print('Error reading %s, requested %d bytes: %s' % (hex(address), size, e))
+        return None
+
+    async def GetAddresses(self, regions):
+        """Read a list of (address, size) regions, returning a list of bytes in the same order.
+
+        Adjacent and overlapping regions are merged and sent as multi-operand
+        GetAddress requests.  Older servers hang up on those; the connection
+        is then opened again, the regions read one merged range at a time,
+        and later calls on this snes skip multi-operand requests.
+        """
+        return await self._retry(lambda: self._getaddresses(regions))
+
+    async def _getaddresses(self, regions):
+        merged = _merge_regions(regions)
+        if not merged:
+            return []
+
+        data = bytearray(sum(end - start for start, end in merged))
+        view = memoryview(data)
+        if self.multi_getaddress and len(merged) > 1:
+            # the batches are pipelined, so they cost one round-trip between them
+            reads = []
+            pos = 0
+            for idx in range(0, len(merged), GETADDRESS_MAX_REGIONS):
+                batch = merged[idx:idx + GETADDRESS_MAX_REGIONS]
+                size = sum(end - start for start, end in batch)
+                reads.append(self._getaddress(batch, view[pos:pos + size]))
+                pos += size
+            results = await asyncio.gather(*reads)
+            if all(result is not None and result is not False for result in results):
+                return _split_regions(regions, merged, data)
+
+            # a timeout says nothing about the server, _retry reads again after a reconnect
+            if not any(result is False for result in results):
+                return None
+            print('Multi-operand GetAddress rejected, reading one range at a time from now on')
+            self.multi_getaddress = False
+            # the server hung up, reopen the connection ourselves unless a reconnect is on its way
+            if not (await self._reattached() if self.reconnect else await self._reopen()):
                 return None
 
-            GetAddress_Request = {
-                "Opcode" : "GetAddress",
-                "Space" : "SNES",
-                "Operands" : [hex(address)[2:], hex(size)[2:]]
-            }
-            try:
-                await self.socket.send(json.dumps(GetAddress_Request))
-            except websockets.ConnectionClosed:
+        pos = 0
+        for start, end in merged:
+            if await self._getaddressinto(start, view[pos:pos + end - start]) is None:
                 return None
+            pos += end - start
+        return _split_regions(regions, merged, data)
 
-            data = bytes()
-            while len(data) < size:
-                try:
-                    data += await asyncio.wait_for(self.recv_queue.get(), 5)
-                except asyncio.TimeoutError:
-                    break
+    async def _getaddress(self, ranges, buffer):
+        if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
+            return None
 
-            if len(data) != size:
-                print('Error reading %s, requested %d bytes, received %d' % (hex(address), size, len(data)))
-                if len(data):
-                    print(str(data))
-                if self.socket is not None and not self.socket.closed:
-                    await self.socket.close()
-                return None
+        operands = []
+        for start, end in ranges:
+            operands += [hex(start)[2:], hex(end - start)[2:]]
+        GetAddress_Request = {
+            "Opcode" : "GetAddress",
+            "Space" : "SNES",
+            "Operands" : operands
+        }
+        socket = self.socket
+        try:
+            future = await self.submit(GetAddress_Request, buffer=buffer)
+        except websockets.ConnectionClosed:
+            return None
 
-            return data
-        finally:
-            self.request_lock.release()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), 5)
+        except asyncio.TimeoutError:
+            await self._abandon(future)
+        except usb2snesException:
+            # the server hung up on the request rather than answer it, unless
+            # we closed the connection ourselves after another request timed out
+            if len(ranges) > 1 and self.abandoned is not socket:
+                return False
+        return None
 
     async def PutAddress(self, write_list):
-        try:
-            await self.request_lock.acquire()
+        if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
+            return False
+
+        PutAddress_Request = {
+            "Opcode" : "PutAddress",
+            "Operands" : []
+        }
+
+        if self.is_sd2snes:
+            direct = []
+            wram = []
+            for address, data in write_list:
+                if address + len(data) <= WRAM_START:
+                    # ROM and SRAM live in cartridge memory the SD2SNES writes itself
+                    direct.append((address, data))
+                elif address >= WRAM_START and address + len(data) <= WRAM_START + WRAM_SIZE:
+                    wram.append((address, data))
+                else:
+                    print("SD2SNES: Write out of range %s (%d)" % (hex(address), len(data)))
+                    return False
 
-            if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
+            try:
+                await self._putaddress(_merge_writes(direct))
+
+                if not wram:
+                    # ROM and SRAM only, there is nothing for the NMI hook to do
+                    return True
+                PutAddress_Request['Space'] = 'CMD'
+                for cmd in _sd2snes_payloads(_merge_writes(wram)):
+                    # overwriting a payload the hook has not run yet would lose its writes
+                    if not await self._sd2snes_idle():
+                        return False
+                    PutAddress_Request['Operands'] = ["2C00", hex(len(cmd)-1)[2:], "2C00", "1"]
+                    await self._send(PutAddress_Request, [cmd])
+            except websockets.ConnectionClosed:
+                return False
+        else:
+            try:
+                await self._putaddress(_merge_writes(write_list))
+            except websockets.ConnectionClosed:
                 return False
 
+        return True
+
+    async def _sd2snes_idle(self):
+        # every payload ends by clearing $2C00, disarming the hook once it ran
+        deadline = time.monotonic() + SD2SNES_PAYLOAD_TIMEOUT
+        flag = bytearray(1)
+        while True:
+            if await self._getaddressinto(0x2C00, flag, space='CMD') is None:
+                return False
+            if not flag[0]:
+                return True
+            if time.monotonic() >= deadline:
+                print("SD2SNES: NMI hook did not run the last write payload within %s seconds" % SD2SNES_PAYLOAD_TIMEOUT)
+                return False
+            await asyncio.sleep(SD2SNES_POLL_INTERVAL)
+
+    async def _putaddress(self, runs):
+        # with multi_putaddress, up to PUTADDRESS_MAX_REGIONS runs share a request and a data frame
+        batch = PUTADDRESS_MAX_REGIONS if self.multi_putaddress else 1
+        for idx in range(0, len(runs), batch):
+            operands = []
+            for address, data in runs[idx:idx + batch]:
+                operands += [hex(address)[2:], hex(len(data))[2:]]
             PutAddress_Request = {
                 "Opcode" : "PutAddress",
-                "Operands" : []
+                "Space" : "SNES",
+                "Operands" : operands
             }
+            await self._send(PutAddress_Request, [b''.join(data for address, data in runs[idx:idx + batch])])
 
-            if self.is_sd2snes:
-                cmd = b'\x00\xE2\x20\x48\xEB\x48'
-
-                for address, data in write_list:
-                    if (address < WRAM_START) or ((address + len(data)) > (WRAM_START + WRAM_SIZE)):
-                        print("SD2SNES: Write out of range %s (%d)" % (hex(address), len(data)))
-                        return False
-                    for ptr, byte in enumerate(data, address + 0x7E0000 - WRAM_START):
-                        cmd += b'\xA9' # LDA
-                        cmd += bytes([byte])
-                        cmd += b'\x8F' # STA.l
-                        cmd += bytes([ptr & 0xFF, (ptr >> 8) & 0xFF, (ptr >> 16) & 0xFF])
+    async def GetFile(self, filepath, dstfile=None, progress=None):
+        """Download a file from the SD card, writing it to dstfile when given and returning its size, otherwise returning its contents."""
+        if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
+            return None
 
-                cmd += b'\xA9\x00\x8F\x00\x2C\x00\x68\xEB\x68\x28\x6C\xEA\xFF\x08'
+        stream = self.GetFileStream(filepath, progress)
+        try:
+            if dstfile is None:
+                data = bytearray()
+                async for chunk in stream:
+                    data += chunk
+                return data
+
+            size = 0
+            async with aiofiles.open(dstfile, 'wb') as outfile:
+                async for chunk in stream:
+                    await outfile.write(chunk)
+                    size += len(chunk)
+            return size
+        except (usb2snesException, websockets.ConnectionClosed) as e:
+            print('Error reading %s: %s' % (filepath, e))
+            return None
+        finally:
+            await stream.aclose()
+
+    async def GetFileStream(self, filepath, progress=None, maxsize=16):
+        """Download a file from the SD card as an async iterator of chunks.
+
+        At most maxsize frames are buffered; beyond that the websocket is not
+        read until the consumer catches up, for up to STREAM_STALL_TIMEOUT
+        seconds, after which the rest of the file is discarded and the
+        stream fails.  Close the iterator with aclose() when stopping early.
+        progress, when given, is called with (received, size, bytes per
+        second) after every chunk.
+        """
+        request = {
+            "Opcode" : "GetFile",
+            "Space" : "SNES",
+            "Operands" : [filepath]
+        }
+        stream = _stream(maxsize)
+        future = await self.submit(request, stream=stream)
+        try:
+            size = await asyncio.wait_for(asyncio.shield(future), 5)
+        except asyncio.TimeoutError:
+            await self._abandon(future)
+            raise usb2snesException('Timed out waiting for the size of %s' % filepath)
 
-                PutAddress_Request['Space'] = 'CMD'
-                PutAddress_Request['Operands'] = ["2C00", hex(len(cmd)-1)[2:], "2C00", "1"]
-                try:
-                    if self.socket is not None:
-                        await self.socket.send(json.dumps(PutAddress_Request))
-                    if self.socket is not None:
-                        await self.socket.send(cmd)
-                except websockets.ConnectionClosed:
-                    return False
-            else:
-                PutAddress_Request['Space'] = 'SNES'
+        received = 0
+        start = time.monotonic()
+        try:
+            while received < size:
                 try:
-                    #will pack those requests as soon as qusb2snes actually supports that for real
-                    for address, data in write_list:
-                        PutAddress_Request['Operands'] = [hex(address)[2:], hex(len(data))[2:]]
-                        if self.socket is not None:
-                            await self.socket.send(json.dumps(PutAddress_Request))
-                        if self.socket is not None:
-                            await self.socket.send(data)
-                except websockets.ConnectionClosed:
-                    return False
-
-            return True
+                    chunk = await asyncio.wait_for(stream.queue.get(), 5)
+                except asyncio.TimeoutError:
+                    break
+                if chunk is None:
+                    break
+                received += len(chunk)
+                if progress is not None:
+                    progress(received, size, received / max(time.monotonic() - start, 1e-6))
+                yield chunk
         finally:
-            self.request_lock.release()
-
-    # async def GetFile(self, filepath):
-    #     try:
-    #         await self.request_lock.acquire()
-
-    #         if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
-    #             return None
-
-    #         request = {
-    #             "Opcode" : "GetFile",
-    #             "Space" : "SNES",
-    #             "Operands" : [filepath]
-    #         }
-    #         try:
-    #             await self.socket.send(json.dumps(request))
-    #         except websockets.ConnectionClosed:
-    #             return None
-
-    #         data = bytes()
-    #         while len(data) < size:
-    #             try:
-    #                 data += await asyncio.wait_for(self.recv_queue.get(), 5)
-    #             except asyncio.TimeoutError:
-    #                 break
-
-    #         if len(data) != size:
-    #             print('Error reading %s, requested %d bytes, received %d' % (hex(address), size, len(data)))
-    #             if len(data):
-    #                 print(str(data))
-    #             if self.socket is not None and not self.socket.closed:
-    #                 await self.socket.close()
-    #             return None
-
-    #         return data
-    #     finally:
-    #         self.request_lock.release()
-
-    async def PutFile(self, srcfile, dstfile):
-        try:
-            await self.request_lock.acquire()
+            if received < size and stream.error is None:
+                # the consumer stopped early, throw the rest of the file away
+                stream.discard = True
+                while not stream.queue.empty():
+                    stream.queue.get_nowait()
+
+        if stream.error is not None:
+            raise stream.error
+        if received != size:
+            if self.socket is not None and not self.socket.closed:
+                await self.socket.close()
+            raise usb2snesException('Error reading %s, expected %d bytes, received %d' % (filepath, size, received))
+
+    async def PutFile(self, srcfile, dstfile, chunk_size=PUTFILE_CHUNK_SIZE, progress=None, wait=True):
+        """Upload srcfile to dstfile on the SD card and wait until the server has finished writing it.
+
+        The server handles requests in order, so the reply to a List of the
+        destination directory only arrives once the file is written; its
+        timeout scales with the file size.  With wait=False PutFile returns
+        as soon as the file is sent, leaving that to the caller, who can
+        confirm several uploads with one call to written().  progress, when given, is called with
+        (sent, size, bytes per second) after every chunk.
+        """
+        if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
+            return None
 
-            if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
-                return None
+        size = os.path.getsize(srcfile)
+        async with aiofiles.open(srcfile, 'rb') as infile:
+            request = {
+                "Opcode" : "PutFile",
+                "Space" : "SNES",
+                "Operands" : [dstfile, hex(size)[2:]]
+            }
+            try:
+                # the file frames must not interleave with other requests
+                waiting = time.perf_counter()
+                async with self.send_lock:
+                    lock_wait = time.perf_counter() - waiting
+                    if self.socket is None:
+                        return False
+                    message = _encode(request)
+                    await self.socket.send(message)
+                    sent = 0
+                    start = time.monotonic()
+                    while True:
+                        chunk = await infile.read(chunk_size)
+                        if not chunk: break
+                        # send() holds us back while the websocket's write buffer is above write_limit
+                        await self.socket.send(chunk)
+                        sent += len(chunk)
+                        if progress is not None:
+                            progress(sent, size, sent / max(time.monotonic() - start, 1e-6))
+            except websockets.ConnectionClosed:
+                self.metrics.completed('PutFile', 'error')
+                return False
+            self.metrics.sent('PutFile', len(message) + size, lock_wait, len(self.pending))
 
-            size = os.path.getsize(srcfile)
-            async with aiofiles.open(srcfile, 'rb') as infile:
-                request = {
-                    "Opcode" : "PutFile",
-                    "Space" : "SNES",
-                    "Operands" : [dstfile, hex(size)[2:]]
-                }
-                try:
-                    if self.socket is not None:
-                        await self.socket.send(json.dumps(request))
-                    if self.socket is not None:
-                        while True:
-                            chunk = await infile.read(4096)
-                            if not chunk: break
-                            await self.socket.send(chunk)
-                except websockets.ConnectionClosed:
-                    return False
+        if not wait:
+            # requests are handled in order, any later List is answered with the file in it
+            self._cache_add(dstfile, '1')
+            self.metrics.completed('PutFile', 'sent', bytes_out=len(message) + size, lock_wait=lock_wait)
+            return True
+        parent, filename = dstfile.rsplit('/', 1)
+        written = filename in await self.written(parent, [filename], size)
+        self.metrics.completed('PutFile', 'ok' if written else 'error', time.monotonic() - start if written else None, bytes_out=len(message) + size, lock_wait=lock_wait)
+        return written
+
+    async def written(self, dirpath, filenames, size):
+        """Wait for size bytes of uploads to dirpath to be written, returning which of filenames it lists.
+
+        This is the confirmation PutFile skips with wait=False: a List of
+        dirpath, answered once the server has written the uploads sent
+        before it, with a timeout that allows for size bytes at
+        PUTFILE_MIN_RATE.
+        """
+        listing = await self._list(dirpath or '/', timeout=5 + size / PUTFILE_MIN_RATE)
+        if listing is None:
+            return []
+        listed = set(d['filename'].lower() for d in listing)
+        return [filename for filename in filenames if filename.lower() in listed]
+
+    async def submit(self, request, size=None, data=None, buffer=None, stream=None):
+        """Send a request and return a future for its reply without waiting for it.
+
+        The future resolves to the decoded JSON reply, or to a binary reply of
+        size bytes, received into buffer when one is given.  Replies are
+        matched to requests in the order they were sent, and at most
+        max_inflight requests are outstanding at once.
+        """
+        if buffer is not None:
+            size = memoryview(buffer).nbytes
+
+        await self.inflight.acquire()
+        pending = _pending(request['Opcode'], size, buffer, stream)
+        pending.future.add_done_callback(lambda future: self._done(pending))
+        if size == 0:
+            pending.future.set_result(pending.buffer)
 
-                return True
-        finally:
-            self.request_lock.release()
-            if size > 2048*1024:
-                await asyncio.sleep(20) #even more ugly hacks for really large ROMs
-            await self.List('/') #ugly hack to figure out when the file is actually done copying
+        try:
+            waiting = time.perf_counter()
+            async with self.send_lock:
+                pending.lock_wait = time.perf_counter() - waiting
+                if self.socket is None:
+                    raise websockets.ConnectionClosed(None, None)
+                if not pending.future.done():
+                    self.pending.append(pending)
+                pending.depth = len(self.pending)
+                message = _encode(request)
+                await self.socket.send(message)
+                for frame in data or []:
+                    await self.socket.send(frame)
+                pending.sent = time.perf_counter()
+                pending.bytes_out = len(message) + sum(len(frame) for frame in data or [])
+                self.metrics.sent(pending.opcode, pending.bytes_out, pending.lock_wait, pending.depth)
+        except Exception:
+            if not pending.future.done():
+                pending.future.cancel()
+            raise
+
+        return pending.future
+
+    def _done(self, pending):
+        self.inflight.release()
+        future = pending.future
+        if future.cancelled():
+            status = 'timeout' if pending.sent is not None else 'error'
+        # callers that gave up on a reply (timeouts, cancelled fan-outs) never look at its error
+        elif future.exception() is not None or (pending.sent is None and pending.size != 0):
+            status = 'error'
+        else:
+            status = 'ok'
+        latency = time.perf_counter() - pending.sent if status == 'ok' and pending.sent is not None else None
+        self.metrics.completed(pending.opcode, status, latency, bytes_out=pending.bytes_out, bytes_in=pending.received, lock_wait=pending.lock_wait, depth=pending.depth)
+
+    async def _send(self, request, data=None):
+        # a request cut off between its JSON and data frames would have the
+        # server read the next request as its data, so a cancelled caller only
+        # stops waiting while the frames still go out
+        task = asyncio.ensure_future(self._transmit(request, data))
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        await asyncio.shield(task)
+
+    async def _transmit(self, request, data):
+        waiting = time.perf_counter()
+        async with self.send_lock:
+            lock_wait = time.perf_counter() - waiting
+            if self.socket is None:
+                raise websockets.ConnectionClosed(None, None)
+            message = _encode(request)
+            await self.socket.send(message)
+            for frame in data or []:
+                await self.socket.send(frame)
+        size = len(message) + sum(len(frame) for frame in data or [])
+        self.metrics.sent(request['Opcode'], size, lock_wait, len(self.pending))
+        self.metrics.completed(request['Opcode'], 'sent', bytes_out=size, lock_wait=lock_wait, depth=len(self.pending))
+
+    async def _abandon(self, future):
+        for pending in self.pending:
+            if pending.future is future:
+                break
+        else:
+            return
+        future.cancel()
+        # replies are matched in order, a late reply to this request would be
+        # taken for the next one's, so the connection cannot be reused
+        if self.socket is not None and not self.socket.closed:
+            self.abandoned = self.socket
+            await self.socket.close()
+
+    async def _dispatch(self, msg):
+        if isinstance(msg, str):
+            if not self.pending or self.pending[0].size is not None:
+                raise usb2snesException('Unexpected reply: %s' % msg)
+            pending = self.pending[0]
+            self.metrics.received(pending.opcode, len(msg))
+            reply = _loads(msg)
+            if pending.stream is not None:
+                # streamed replies announce their size, then follow as binary frames
+                pending.size = int(reply['Results'][0], 16)
+                if not pending.future.done():
+                    pending.future.set_result(pending.size)
+                if pending.size:
+                    return
+                await self._feed(pending.stream, None)
+            self.pending.popleft()
+            if not pending.future.done():
+                pending.future.set_result(reply)
+            return
+
+        view = memoryview(msg)
+        while len(view):
+            if not self.pending or self.pending[0].size is None:
+                raise usb2snesException('Unexpected %d bytes of binary data' % len(view))
+            pending = self.pending[0]
+            count = min(pending.size - pending.received, len(view))
+            self.metrics.received(pending.opcode, count)
+            if pending.stream is None:
+                pending.view[pending.received:pending.received + count] = view[:count]
+            elif not pending.stream.discard:
+                await self._feed(pending.stream, msg if count == len(msg) else bytes(view[:count]))
+            pending.received += count
+            view = view[count:]
+            if pending.received == pending.size:
+                self.pending.popleft()
+                if pending.stream is None:
+                    pending.view.release()
+                    if not pending.future.done():
+                        pending.future.set_result(pending.buffer)
+                elif not pending.stream.discard:
+                    await self._feed(pending.stream, None)
+
+    async def _feed(self, stream, chunk):
+        # the receive loop serves every request, a consumer that stopped
+        # reading must not hold it up for longer than STREAM_STALL_TIMEOUT
+        try:
+            await asyncio.wait_for(stream.queue.put(chunk), STREAM_STALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            stream.error = usb2snesException('Stream consumer stalled, the rest of the file was discarded')
+            stream.discard = True
+            while not stream.queue.empty():
+                stream.queue.get_nowait()
+            stream.queue.put_nowait(None)
 
     async def recv_loop(self):
+        socket = self.socket
         try:
-            async for msg in self.socket:
-                self.recv_queue.put_nowait(msg)
+            async for msg in socket:
+                await self._dispatch(msg)
         except Exception as e:
             if type(e) is not websockets.ConnectionClosed:
                 logging.exception(e)
         finally:
-            socket, self.socket = self.socket, None
-            if socket is not None and not socket.closed:
+            if not socket.closed:
                 await socket.close()
+            # a reconnect may already have replaced this socket
+            if self.socket is not None and self.socket is not socket:
+                return
+            self.socket = None
 
             self.state = SNES_DISCONNECTED
-            self.recv_queue = asyncio.Queue()
+            self.attached.clear()
+            if self.reconnect and not self.closing and self.reconnect_task is None:
+                self.reconnect_task = asyncio.create_task(self._reconnect())
+            pending, self.pending = self.pending, collections.deque()
+            for request in pending:
+                if not request.future.done():
+                    request.future.set_exception(usb2snesException('Connection closed'))
+                if request.stream is not None:
+                    request.stream.error = usb2snesException('Connection closed')
+                    try:
+                        request.stream.queue.put_nowait(None)
+                    except asyncio.QueueFull:
+                        pass
 
     async def List(self,dirpath):
+        return await self._retry(lambda: self._listpath(dirpath))
+
+    async def _listpath(self, dirpath):
         if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
             return None
         elif not dirpath.startswith('/') and not dirpath in ['','/']:
@@ -396,65 +904,95 @@ class snes():
                     continue
                 else:
                     parent = '/'.join(path[:idx])
-                    parentlist = await self._list(parent)
-                    
+                    parentlist = await self._cached_list(parent)
+                    if parentlist is None:
+                        return None
+
                     if any(d['filename'].lower() == node for d in parentlist):
                         continue
                     else:
                         raise FileNotFoundError("directory {path} does not exist on usb2snes.".format(
                             path=dirpath
                         ))
-            return await self._list(dirpath)
+            return await self._cached_list(dirpath)
         else:
-            return await self._list(dirpath)
-
-    async def _list(self, dirpath):
+            return await self._cached_list(dirpath)
+
+    async def _cached_list(self, dirpath):
+        cached = self.dircache.get(_cachekey(dirpath))
+        if cached is not None and time.monotonic() - cached[0] < self.dircache_ttl:
+            return list(cached[1])
+        return await self._list(dirpath)
+
+    def invalidate(self, dirpath=None):
+        """Forget the cached listing of dirpath and everything below it, or of every directory."""
+        if dirpath is None:
+            self.dircache.clear()
+            return
+        key = _cachekey(dirpath)
+        for path in list(self.dircache):
+            if path == key or path.startswith(key.rstrip('/') + '/'):
+                del self.dircache[path]
+
+    def _cache_add(self, path, filetype):
+        parent, filename = path.rsplit('/', 1)
+        cached = self.dircache.get(_cachekey(parent))
+        if cached is not None and not any(d['filename'].lower() == filename.lower() for d in cached[1]):
+            cached[1].append({
+                "type": filetype,
+                "filename": filename
+            })
+
+    def _cache_remove(self, path):
+        parent, filename = path.rsplit('/', 1)
+        cached = self.dircache.get(_cachekey(parent))
+        if cached is not None:
+            cached[1][:] = [d for d in cached[1] if d['filename'].lower() != filename.lower()]
+        self.invalidate(path)
+
+    async def _list(self, dirpath, timeout=5):
+        if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
+            return None
         try:
-            await self.request_lock.acquire()
+            request = {
+                'Opcode': 'List',
+                'Space': 'SNES',
+                'Flags': None,
+                'Operands': [dirpath]
+            }
+            results = (await asyncio.wait_for(await self.submit(request), timeout))['Results']
 
-            if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
-                return None
-            try:
-                request = {
-                    'Opcode': 'List',
-                    'Space': 'SNES',
-                    'Flags': None,
-                    'Operands': [dirpath]
+            resultlist = []
+            for filetype, filename in zip(results[::2], results[1::2]):
+                resultdict = {
+                    "type": filetype,
+                    "filename": filename
                 }
-                await self.socket.send(json.dumps(request))
-                results = json.loads(await asyncio.wait_for(self.recv_queue.get(), 5))['Results']
-
-                resultlist = []
-                for filetype, filename in zip(results[::2], results[1::2]):
-                    resultdict = {
-                        "type": filetype,
-                        "filename": filename
-                    }
-                    if not filename in ['.','..']:
-                        resultlist.append(resultdict)
-                return resultlist
-            except Exception as e:
-                if self.socket is not None:
-                    if not self.socket.closed:
-                        await self.socket.close()
-                    self.socket = None
-                self.snes_state = SNES_DISCONNECTED
-        finally:
-            self.request_lock.release()
+                if not filename in ['.','..']:
+                    resultlist.append(resultdict)
+            self.dircache[_cachekey(dirpath)] = (time.monotonic(), resultlist)
+            return list(resultlist)
+        except Exception as e:
+            if self.socket is not None:
+                if not self.socket.closed:
+                    await self.socket.close()
+                self.socket = None
+            self.state = SNES_DISCONNECTED
 
-    async def MakeDir(self,dirpath):
+    async def MakeDir(self, dirpath, parents=False):
         if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
             return None
         if dirpath in ['','/']:
             raise usb2snesException('MakeDir: dirpath cannot be blank or \"/\"')
 
+        # with parents, create every missing directory along the path like mkdir -p
         path = dirpath.split('/')
-        parent = '/'.join(path[:-1])
-        parentdir = await self.List(parent)
-        try:
-            await self.List(dirpath)
-        except FileNotFoundError as e:
-            await self._mkdir(dirpath)
+        for idx in range(2 if parents else len(path), len(path) + 1):
+            parentdir = await self.List('/'.join(path[:idx - 1]))
+            if parentdir is None:
+                return None
+            if not any(d['filename'].lower() == path[idx - 1].lower() for d in parentdir):
+                await self._mkdir('/'.join(path[:idx]))
 
     async def _mkdir(self, dirpath):
         if self.state != SNES_ATTACHED or self.socket is None or not self.socket.open or self.socket.closed:
@@ -466,13 +1004,15 @@ class snes():
                 'Flags': None,
                 'Operands': [dirpath]
             }
-            await self.socket.send(json.dumps(request))
+            await self._send(request)
+            self._cache_add(dirpath, '0')
+            self.dircache[_cachekey(dirpath)] = (time.monotonic(), [])
         except Exception as e:
             if self.socket is not None:
                 if not self.socket.closed:
                     await self.socket.close()
                 self.socket = None
-            self.snes_state = SNES_DISCONNECTED
+            self.state = SNES_DISCONNECTED
 
     async def Remove(self, dirpath):
         """this is pretty broken"""
@@ -486,16 +1026,189 @@ class snes():
                 'Flags': None,
                 'Operands': [dirpath]
             }
-            await self.socket.send(json.dumps(request))
+            await self._send(request)
+            self._cache_remove(dirpath)
         except Exception as e:
             if self.socket is not None:
                 if not self.socket.closed:
                     await self.socket.close()
                 self.socket = None
-            self.snes_state = SNES_DISCONNECTED
+            self.state = SNES_DISCONNECTED
+
+def _json():
+    # pick the JSON backend on first use, orjson when it is installed
+    global _dumps, _loads
+    try:
+        import orjson
+        _dumps = lambda obj: orjson.dumps(obj).decode()
+        _loads = orjson.loads
+    except ImportError:
+        _dumps = lambda obj: json.dumps(obj, separators=(',', ':'))
+        _loads = json.loads
+
+def _dumps(obj):
+    _json()
+    return _dumps(obj)
+
+def _loads(msg):
+    _json()
+    return _loads(msg)
+
+_templates = {}
+
+def _encode(request):
+    """Serialize a request, reusing the encoded Opcode and Space of earlier requests."""
+    key = (request['Opcode'], request.get('Space'))
+    operands = request.get('Operands')
+    if len(request) != 1 + (key[1] is not None) + (operands is not None):
+        return _dumps(request)
+
+    template = _templates.get(key)
+    if template is None:
+        head = {"Opcode" : key[0]}
+        if key[1] is not None:
+            head["Space"] = key[1]
+        template = _templates[key] = _dumps(head)[:-1]
+
+    if operands is None:
+        return template + '}'
+    # hex addresses and sizes need no escaping, paths go through the encoder
+    if operands and all(isinstance(operand, str) and operand.isalnum() for operand in operands):
+        return '%s,"Operands":["%s"]}' % (template, '","'.join(operands))
+    return '%s,"Operands":%s}' % (template, _dumps(operands))
 
 def _listitem(list, index):
     try:
         return list[index]
     except IndexError:
-        return None
\ No newline at end of file
+        return None
+
+def _cachekey(dirpath):
+    return dirpath.lower().rstrip('/') or '/'
+
+def _next_due(due, interval, now):
+    # skip missed intervals rather than reading in a burst to catch up
+    return due + interval if due + interval > now else now + interval
+
+def _merge_regions(regions):
+    merged = []
+    for address, size in sorted(regions):
+        if size <= 0:
+            continue
+        if merged and address <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], address + size)
+        else:
+            merged.append([address, address + size])
+    return [tuple(r) for r in merged]
+
+def _split_regions(regions, merged, data):
+    view = memoryview(data)
+    offsets = []
+    pos = 0
+    for start, end in merged:
+        offsets.append((start, end, pos))
+        pos += end - start
+
+    results = []
+    for address, size in regions:
+        if size <= 0:
+            results.append(bytes())
+            continue
+        for start, end, pos in offsets:
+            if start <= address < end:
+                offset = pos + address - start
+                results.append(bytes(view[offset:offset + size]))
+                break
+    return results
+
+def _merge_writes(write_list):
+    """Combine (address, data) writes into sorted, contiguous runs, later writes winning where they overlap."""
+    runs = [(start, bytearray(end - start)) for start, end in _merge_regions((address, len(data)) for address, data in write_list)]
+    starts = [start for start, buffer in runs]
+    for address, data in write_list:
+        if not len(data):
+            continue
+        start, buffer = runs[bisect.bisect_right(starts, address) - 1]
+        buffer[address - start:address - start + len(data)] = bytes(data)
+    return runs
+
+# PHP is written to $2C00 last to arm the hook, then REP #$30 / PHA / PHX / PHY / PHB
+_SD2SNES_PROLOGUE = b'\x00\xC2\x30\x48\xDA\x5A\x8B'
+# PLB / PLY / PLX / SEP #$20, followed by the 8-bit stores
+_SD2SNES_RESTORE = b'\xAB\x7A\xFA\xE2\x20'
+# LDA #$00 / STA.l $002C00 / REP #$20 / PLA / PLP / JMP ($FFEA)
+_SD2SNES_EPILOGUE = b'\xA9\x00\x8F\x00\x2C\x00\xC2\x20\x68\x28\x6C\xEA\xFF'
+_SD2SNES_OVERHEAD = len(_SD2SNES_PROLOGUE) + len(_SD2SNES_RESTORE) + len(_SD2SNES_EPILOGUE)
+
+def _sd2snes_payloads(runs):
+    """Generate the NMI hook payloads writing (address, data) WRAM runs, each fitting SD2SNES_CMD_SIZE.
+
+    Runs are written with an MVN block copy from the data appended to the
+    payload when that is shorter than immediate stores, otherwise with
+    16-bit LDA #imm / STA.l pairs and a final 8-bit store for odd bytes.
+    """
+    payloads = []
+    ops = []
+    space = SD2SNES_CMD_SIZE - _SD2SNES_OVERHEAD
+    for address, data in runs:
+        ptr = address + 0x7E0000 - WRAM_START
+        pos = 0
+        while pos < len(data):
+            # a block copy wraps within its bank, so never cross from $7E into $7F
+            count = min(len(data) - pos, 0x10000 - (ptr & 0xFFFF))
+            if 12 + count < 7 * (count // 2) + 6 * (count % 2):
+                count = min(count, space - 12)
+                if count > 4:
+                    ops.append((ptr, data[pos:pos + count]))
+                    space -= 12 + count
+                    ptr += count
+                    pos += count
+                    continue
+            elif count >= 2 and space >= 7:
+                ops.append((ptr, data[pos:pos + 2]))
+                space -= 7
+                ptr += 2
+                pos += 2
+                continue
+            elif count == 1 and space >= 6:
+                ops.append((ptr, data[pos:pos + 1]))
+                space -= 6
+                ptr += 1
+                pos += 1
+                continue
+
+            payloads.append(_sd2snes_payload(ops))
+            ops = []
+            space = SD2SNES_CMD_SIZE - _SD2SNES_OVERHEAD
+
+    if ops or not payloads:
+        payloads.append(_sd2snes_payload(ops))
+    return payloads
+
+def _sd2snes_payload(ops):
+    blocks = [(ptr, data) for ptr, data in ops if len(data) > 2]
+    words = [(ptr, data) for ptr, data in ops if len(data) == 2]
+    single = [(ptr, data) for ptr, data in ops if len(data) == 1]
+
+    code_size = _SD2SNES_OVERHEAD + 12 * len(blocks) + 7 * len(words) + 6 * len(single)
+    src = 0x2C00 + code_size
+
+    cmd = bytearray(_SD2SNES_PROLOGUE)
+    for ptr, data in blocks:
+        cmd += b'\xA9' + (len(data) - 1).to_bytes(2, 'little') # LDA #count-1
+        cmd += b'\xA2' + src.to_bytes(2, 'little') # LDX #src
+        cmd += b'\xA0' + (ptr & 0xFFFF).to_bytes(2, 'little') # LDY #dst
+        cmd += bytes([0x54, ptr >> 16, 0x00]) # MVN $00,dst
+        src += len(data)
+    for ptr, data in words:
+        cmd += b'\xA9' + bytes(data) # LDA #imm16
+        cmd += b'\x8F' + ptr.to_bytes(3, 'little') # STA.l
+    cmd += _SD2SNES_RESTORE
+    for ptr, data in single:
+        cmd += b'\xA9' + bytes(data) # LDA #imm
+        cmd += b'\x8F' + ptr.to_bytes(3, 'little') # STA.l
+    cmd += _SD2SNES_EPILOGUE
+    for ptr, data in blocks:
+        cmd += data
+    cmd += b'\x08' # PHP
+    return bytes(cmd)
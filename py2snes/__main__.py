@@ -0,0 +1,5 @@
+import sys
+
+from py2snes.cli import main
+
+sys.exit(main())
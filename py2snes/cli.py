@@ -0,0 +1,330 @@
+"""Command line access to a console through QUsb2snes.
+
+    py2snes get F50010 16
+    py2snes putfile seed.sfc /seeds/seed.sfc
+    py2snes daemon &
+
+Every run connects and attaches to the device, unless a daemon started
+with `py2snes daemon` is listening and attached through the same --address
+and --device; then the command is handed to it and runs over the
+connection it keeps open.  The daemon path never imports asyncio or
+websockets, so it starts in a few milliseconds.
+
+The daemon reads and writes local files for its callers, so only the user
+who started it may reach it: it listens on a Unix socket in a directory
+only that user can open, or where there are none, on a local TCP port that
+requires a token kept in such a directory.
+"""
+import argparse
+import hmac
+import json
+import os
+import secrets
+import socket
+import sys
+
+DAEMON_PORT = 23080
+
+_UNIX_SOCKETS = hasattr(socket, 'AF_UNIX') and sys.platform != 'win32'
+
+# arguments naming local files, made absolute before they are handed to the daemon
+_LOCAL_PATHS = ('local', 'input', 'output')
+
+def _address(value):
+    return int(value.lstrip('$').lower().replace('0x', ''), 16)
+
+def _hexdump(address, data):
+    lines = []
+    for pos in range(0, len(data), 16):
+        lines.append('%06x  %s' % (address + pos, ' '.join('%02x' % b for b in data[pos:pos + 16])))
+    return '\n'.join(lines)
+
+async def _devices(snes, args):
+    devices = await snes.DeviceList()
+    return '\n'.join(devices or []), 0 if devices is not None else 1
+
+async def _info(snes, args):
+    info = await snes.Info()
+    if info is None:
+        return 'Could not read the device info', 1
+    return '\n'.join('%s: %s' % (key, value) for key, value in info.items() if value is not None), 0
+
+async def _get(snes, args):
+    data = await snes.GetAddress(args.address, args.size)
+    if data is None:
+        return 'Could not read %s' % hex(args.address), 1
+    if args.output is not None:
+        with open(args.output, 'wb') as outfile:
+            outfile.write(data)
+        return '', 0
+    return _hexdump(args.address, data), 0
+
+async def _put(snes, args):
+    if args.input is not None:
+        with open(args.input, 'rb') as infile:
+            data = infile.read()
+    elif args.data is not None:
+        data = bytes.fromhex(args.data)
+    else:
+        return 'Nothing to write, give hex data or --input', 2
+    if not await snes.PutAddress([(args.address, data)]):
+        return 'Could not write %s' % hex(args.address), 1
+    return '', 0
+
+async def _putfile(snes, args):
+    if not await snes.PutFile(args.local, args.remote):
+        return 'Could not upload %s' % args.local, 1
+    return '', 0
+
+def _default_local(args):
+    # getfile saves to the remote name in the caller's working directory
+    if args.command == 'getfile' and args.local is None:
+        args.local = args.remote.rstrip('/').rsplit('/', 1)[-1]
+
+async def _getfile(snes, args):
+    if await snes.GetFile(args.remote, args.local) is None:
+        return 'Could not download %s' % args.remote, 1
+    return '', 0
+
+async def _ls(snes, args):
+    # a daemon's cached listing may predate changes made by other clients
+    snes.invalidate(args.remote)
+    try:
+        listing = await snes.List(args.remote)
+    except FileNotFoundError as e:
+        return str(e), 1
+    if listing is None:
+        return 'Could not list %s' % args.remote, 1
+    return '\n'.join(d['filename'] + ('' if d['type'] == '1' else '/') for d in listing), 0
+
+async def _mkdir(snes, args):
+    await snes.MakeDir(args.remote, parents=args.parents)
+    return _sent(snes, 'Could not create %s' % args.remote)
+
+async def _rm(snes, args):
+    await snes.Remove(args.remote)
+    return _sent(snes, 'Could not remove %s' % args.remote)
+
+async def _boot(snes, args):
+    await snes.Boot(args.remote)
+    return _sent(snes, 'Could not boot %s' % args.remote)
+
+async def _reset(snes, args):
+    await snes.Reset()
+    return _sent(snes, 'Could not reset')
+
+async def _menu(snes, args):
+    await snes.Menu()
+    return _sent(snes, 'Could not return to the menu')
+
+def _sent(snes, error):
+    # these requests have no reply, a failed send leaves the snes detached
+    from py2snes import SNES_ATTACHED
+    return ('', 0) if snes.state == SNES_ATTACHED else (error, 1)
+
+_COMMANDS = {
+    'devices': _devices,
+    'info': _info,
+    'get': _get,
+    'put': _put,
+    'putfile': _putfile,
+    'getfile': _getfile,
+    'ls': _ls,
+    'mkdir': _mkdir,
+    'rm': _rm,
+    'boot': _boot,
+    'reset': _reset,
+    'menu': _menu,
+}
+
+async def _execute(snes, args):
+    try:
+        return await _COMMANDS[args.command](snes, args)
+    except Exception as e:
+        return '%s: %s' % (type(e).__name__, e), 1
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='py2snes', description='Talk to an SNES through QUsb2snes.')
+    parser.add_argument('--address', dest='server', default='ws://localhost:8080', help='QUsb2snes websocket address')
+    parser.add_argument('--device', help='device to attach to, the first one by default')
+    parser.add_argument('--port', type=int, default=DAEMON_PORT, help='local port of the daemon, also naming its socket')
+    parser.add_argument('--no-daemon', action='store_true', help='connect directly even when a daemon is running')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    commands.add_parser('devices', help='list the devices QUsb2snes knows')
+    commands.add_parser('info', help='show the attached device info')
+    command = commands.add_parser('get', help='read memory')
+    command.add_argument('address', type=_address, help='address in hex')
+    command.add_argument('size', type=lambda value: int(value, 0))
+    command.add_argument('-o', '--output', help='write the bytes to a file instead of a hex dump')
+    command = commands.add_parser('put', help='write memory')
+    command.add_argument('address', type=_address, help='address in hex')
+    command.add_argument('data', nargs='?', help='bytes in hex')
+    command.add_argument('-i', '--input', help='write the contents of a file')
+    command = commands.add_parser('putfile', help='upload a file to the SD card')
+    command.add_argument('local')
+    command.add_argument('remote')
+    command = commands.add_parser('getfile', help='download a file from the SD card')
+    command.add_argument('remote')
+    command.add_argument('local', nargs='?')
+    command = commands.add_parser('ls', help='list a directory on the SD card')
+    command.add_argument('remote', nargs='?', default='/')
+    command = commands.add_parser('mkdir', help='create a directory on the SD card')
+    command.add_argument('remote')
+    command.add_argument('-p', '--parents', action='store_true', help='create missing parent directories too')
+    command = commands.add_parser('rm', help='remove a file or directory from the SD card')
+    command.add_argument('remote')
+    command = commands.add_parser('boot', help='boot a ROM from the SD card')
+    command.add_argument('remote')
+    commands.add_parser('reset', help='reset the console')
+    commands.add_parser('menu', help='return to the menu')
+    commands.add_parser('daemon', help='keep a connection open for later commands to use')
+    return parser
+
+async def _attach(args, reconnect=False):
+    from py2snes import snes, SNES_CONNECTED
+
+    client = snes(reconnect=reconnect)
+    await client.connect(args.server)
+    if client.state != SNES_CONNECTED:
+        return None
+    devices = await client.DeviceList()
+    device = args.device or (devices[0] if devices else None)
+    if device is None:
+        print('No device found')
+        await client.close()
+        return None
+    await client.Attach(device)
+    return client
+
+async def _run(args):
+    client = await _attach(args)
+    if client is None:
+        return 'Could not attach to a device through %s' % args.server, 1
+    try:
+        return await _execute(client, args)
+    finally:
+        await client.close()
+
+def _daemon_path(port, suffix):
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    base = os.path.join(base, 'py2snes') if base else os.path.join(os.path.expanduser('~'), '.py2snes')
+    return os.path.join(base, 'daemon-%d.%s' % (port, suffix))
+
+def _daemon_connect(port):
+    """Connect to the daemon, returning (socket, token) or (None, None) when there is none."""
+    if _UNIX_SOCKETS:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.settimeout(1)
+        try:
+            sock.connect(_daemon_path(port, 'sock'))
+        except OSError:
+            sock.close()
+            return None, None
+        return sock, None
+    try:
+        with open(_daemon_path(port, 'token')) as infile:
+            token = infile.read()
+        return socket.create_connection(('127.0.0.1', port), timeout=1), token
+    except OSError:
+        return None, None
+
+async def _daemon(args):
+    import asyncio
+
+    sock, token = _daemon_connect(args.port)
+    if sock is not None:
+        sock.close()
+        print('A daemon is already running on port %d' % args.port)
+        return 1
+
+    client = await _attach(args, reconnect=True)
+    if client is None:
+        print('Could not attach to a device through %s' % args.server)
+        return 1
+
+    async def handle(reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            if token is not None and not hmac.compare_digest(request.pop('token', None) or '', token):
+                return
+            request = argparse.Namespace(**request)
+            if request.server != args.server or request.device not in (None, client.device):
+                # not the connection the caller asked for, it connects on its own
+                writer.write(json.dumps({"server": args.server, "device": client.device}).encode() + b'\n')
+                await writer.drain()
+                return
+            output, status = await _execute(client, request)
+            writer.write(json.dumps({"output": output, "status": status}).encode() + b'\n')
+            await writer.drain()
+        finally:
+            writer.close()
+
+    path = _daemon_path(args.port, 'sock' if _UNIX_SOCKETS else 'token')
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    os.chmod(os.path.dirname(path), 0o700)
+    if _UNIX_SOCKETS:
+        # left behind by a daemon that did not shut down cleanly
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(handle, path)
+        os.chmod(path, 0o600)
+        where = path
+    else:
+        token = secrets.token_hex(16)
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as outfile:
+            outfile.write(token)
+        server = await asyncio.start_server(handle, '127.0.0.1', args.port)
+        where = '127.0.0.1:%d' % args.port
+    print('py2snes daemon attached to %s, listening on %s' % (client.device, where))
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
+        await client.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+def _daemon_request(args):
+    """Hand the command to a running daemon, returning its (output, status) or None when there is none.
+
+    None is also returned when the daemon is attached through another
+    server or to another device than the command asks for.
+    """
+    sock, token = _daemon_connect(args.port)
+    if sock is None:
+        return None
+    request = dict(vars(args), token=token)
+    for key in _LOCAL_PATHS:
+        if request.get(key) is not None:
+            request[key] = os.path.abspath(request[key])
+    with sock:
+        sock.settimeout(None)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        reply = b''.join(iter(lambda: sock.recv(65536), b''))
+    if not reply:
+        return None
+    reply = json.loads(reply)
+    if 'output' not in reply:
+        return None
+    return reply['output'], reply['status']
+
+def main(argv=None):
+    args = _parser().parse_args(argv)
+    _default_local(args)
+    if args.command == 'daemon':
+        import asyncio
+        try:
+            return asyncio.run(_daemon(args))
+        except KeyboardInterrupt:
+            return 0
+
+    result = None if args.no_daemon else _daemon_request(args)
+    if result is None:
+        import asyncio
+        result = asyncio.run(_run(args))
+    output, status = result
+    if output:
+        print(output, file=sys.stdout if status == 0 else sys.stderr)
+    return status
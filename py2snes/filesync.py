@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import time
+
+from py2snes import usb2snesException
+
+def _sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1024*1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+async def sync(snes, local_dir, remote_dir, manifest=None, delete=False, progress=None):
+    """Mirror local_dir onto remote_dir on the SD card, uploading only what changed.
+
+    List does not report file sizes, so a file is only known to be up to date
+    when it exists on the SD card and matches its entry in the manifest, a
+    local JSON file recording the size, mtime and SHA-1 of every file this
+    function uploaded.  Without a manifest every file is uploaded.  Missing
+    directories are created first, then each directory's files are sent back
+    to back and confirmed with a single List.  With delete, remote entries
+    that do not exist locally are removed.  progress, when given, is called
+    with (sent, total, bytes per second) for the whole transfer.
+
+    Returns a dict with the uploaded, skipped and removed paths, the number
+    of bytes sent, the elapsed seconds and the rate.
+    """
+    remote_dir = remote_dir.rstrip('/')
+    records = {}
+    if manifest is not None and os.path.exists(manifest):
+        with open(manifest) as infile:
+            records = json.load(infile)
+
+    uploads = []
+    skipped = []
+    removed = []
+    for root, dirs, files in os.walk(local_dir):
+        dirs.sort()
+        rel = os.path.relpath(root, local_dir).replace(os.sep, '/')
+        remote = remote_dir if rel == '.' else '%s/%s' % (remote_dir, rel)
+
+        try:
+            listing = await snes.List(remote)
+        except FileNotFoundError:
+            await snes.MakeDir(remote, parents=True)
+            listing = []
+        if listing is None:
+            raise usb2snesException('Could not list %s' % remote)
+        existing = set(d['filename'].lower() for d in listing)
+
+        for filename in sorted(files):
+            localpath = os.path.join(root, filename)
+            relpath = filename if rel == '.' else '%s/%s' % (rel, filename)
+            stat = os.stat(localpath)
+            record = records.get(relpath)
+            if filename.lower() in existing and record is not None and record['size'] == stat.st_size:
+                # quick check on mtime, falling back to the hash when it was touched
+                if record['mtime'] == stat.st_mtime or record['sha1'] == _sha1(localpath):
+                    record['mtime'] = stat.st_mtime
+                    skipped.append(relpath)
+                    continue
+            uploads.append((remote, filename, localpath, relpath, stat))
+
+        if delete:
+            local = set(name.lower() for name in files + dirs)
+            for d in listing:
+                if d['filename'].lower() not in local:
+                    await snes.Remove('%s/%s' % (remote, d['filename']))
+                    removed.append('%s/%s' % (remote, d['filename']))
+
+    total = sum(stat.st_size for remote, filename, localpath, relpath, stat in uploads)
+    sent = 0
+    start = time.monotonic()
+    uploaded = []
+    idx = 0
+    try:
+        while idx < len(uploads):
+            remote = uploads[idx][0]
+            batch = []
+            while idx < len(uploads) and uploads[idx][0] == remote:
+                batch.append(uploads[idx])
+                idx += 1
+
+            size = 0
+            for remote, filename, localpath, relpath, stat in batch:
+                def report(done, filesize, rate):
+                    if progress is not None:
+                        progress(sent + done, total, (sent + done) / max(time.monotonic() - start, 1e-6))
+                if not await snes.PutFile(localpath, '%s/%s' % (remote, filename), progress=report, wait=False):
+                    raise usb2snesException('Could not upload %s' % localpath)
+                sent += stat.st_size
+                size += stat.st_size
+
+            # the server writes uploads in order, one List confirms the whole directory
+            written = await snes.written(remote, [filename for remote, filename, localpath, relpath, stat in batch], size)
+            for remote, filename, localpath, relpath, stat in batch:
+                if filename not in written:
+                    raise usb2snesException('Upload of %s to %s did not complete' % (localpath, remote))
+                uploaded.append(relpath)
+                if manifest is not None:
+                    records[relpath] = {
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime,
+                        "sha1": _sha1(localpath),
+                    }
+    finally:
+        # keep what was confirmed even when a later upload fails
+        if manifest is not None:
+            with open(manifest, 'w') as outfile:
+                json.dump(records, outfile, indent=2, sort_keys=True)
+
+    seconds = time.monotonic() - start
+    return {
+        "uploaded": uploaded,
+        "skipped": skipped,
+        "removed": removed,
+        "bytes": sent,
+        "seconds": seconds,
+        "rate": sent / max(seconds, 1e-6),
+    }
@@ -0,0 +1,134 @@
+import struct
+
+from py2snes import _merge_regions
+
+_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+class field():
+    def __init__(self, name, address, width, endian, signed, bits, count):
+        self.name = name
+        self.address = address
+        self.width = width
+        self.endian = endian
+        self.signed = signed
+        self.bits = bits
+        self.count = count
+        self.size = width * (count or 1)
+        self.offset = None
+
+class memorymap():
+    """Named fields in SNES memory, read with one batched request and decoded in bulk.
+
+    Fields are declared with add() at the addresses GetAddress uses, for
+    instance WRAM_START + 0xF36D, as unsigned or signed integers of 1, 2, 3,
+    4 or 8 bytes in either byte order.  bits=(shift, length) extracts a
+    bitfield and count=n makes the field an array, decoded to a tuple.
+
+    compile() merges the fields into as few address ranges as possible,
+    bridging gaps of up to gap bytes since reading a few spare bytes is
+    cheaper than another range, and builds struct formats that unpack every
+    field of the snapshot in one call per byte order.  read() returns all
+    values and poll() only the ones that changed since the last poll.
+    """
+    def __init__(self, snes, gap=16):
+        self.snes = snes
+        self.gap = gap
+        self.fields = []
+        self.values = {}
+        self.regions = None
+        self.unpackers = None
+
+    def add(self, name, address, width=1, endian='little', signed=False, bits=None, count=None):
+        if width not in (1, 2, 3, 4, 8):
+            raise ValueError('Unsupported width %d for %s' % (width, name))
+        if endian not in ('little', 'big'):
+            raise ValueError('Unsupported byte order %s for %s' % (endian, name))
+        f = field(name, address, width, endian, signed, bits, count)
+        self.fields.append(f)
+        self.regions = None
+        return f
+
+    def compile(self):
+        regions = []
+        for start, end in _merge_regions((f.address, f.size) for f in self.fields):
+            if regions and start - regions[-1][1] <= self.gap:
+                regions[-1][1] = end
+            else:
+                regions.append([start, end])
+
+        pos = 0
+        offsets = []
+        for start, end in regions:
+            offsets.append((start, end, pos))
+            pos += end - start
+        for f in self.fields:
+            for start, end, pos in offsets:
+                if start <= f.address < end:
+                    f.offset = pos + f.address - start
+                    break
+
+        # fields that do not overlap share a format, so one unpack_from decodes them all
+        lanes = []
+        for f in sorted(self.fields, key=lambda f: f.offset):
+            for lane in lanes:
+                if lane['endian'] == f.endian and lane['end'] <= f.offset:
+                    break
+            else:
+                lane = {'endian': f.endian, 'end': 0, 'format': [], 'values': 0, 'targets': []}
+                lanes.append(lane)
+            if f.offset > lane['end']:
+                lane['format'].append('%dx' % (f.offset - lane['end']))
+            if f.width == 3:
+                lane['format'].append('%ds' % f.size)
+                lane['targets'].append((f, lane['values']))
+                lane['values'] += 1
+            else:
+                char = _FORMATS[f.width].lower() if f.signed else _FORMATS[f.width]
+                lane['format'].append('%d%s' % (f.count or 1, char))
+                lane['targets'].append((f, lane['values']))
+                lane['values'] += f.count or 1
+            lane['end'] = f.offset + f.size
+
+        self.regions = [(start, end - start) for start, end in regions]
+        self.unpackers = [
+            (struct.Struct(('<' if lane['endian'] == 'little' else '>') + ''.join(lane['format'])), lane['targets'])
+            for lane in lanes
+        ]
+
+    def decode(self, snapshot):
+        """Decode a snapshot of the compiled regions, laid out back to back, into a dict of field values."""
+        if self.regions is None:
+            self.compile()
+
+        values = {}
+        for unpacker, targets in self.unpackers:
+            raw = unpacker.unpack_from(snapshot)
+            for f, index in targets:
+                if f.width == 3:
+                    items = [int.from_bytes(raw[index][pos:pos + 3], f.endian, signed=f.signed) for pos in range(0, f.size, 3)]
+                else:
+                    items = raw[index:index + (f.count or 1)]
+                if f.bits is not None:
+                    shift, length = f.bits
+                    mask = (1 << length) - 1
+                    items = [(value >> shift) & mask for value in items]
+                values[f.name] = tuple(items) if f.count is not None else items[0]
+        return values
+
+    async def read(self):
+        """Read every field, returning a dict of values or None if the read failed."""
+        if self.regions is None:
+            self.compile()
+        results = await self.snes.GetAddresses(self.regions)
+        if results is None:
+            return None
+        return self.decode(b''.join(results))
+
+    async def poll(self):
+        """Read every field, returning a dict of the ones that changed since the last poll or None if the read failed."""
+        values = await self.read()
+        if values is None:
+            return None
+        changes = dict((name, value) for name, value in values.items() if name not in self.values or self.values[name] != value)
+        self.values = values
+        return changes
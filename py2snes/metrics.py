@@ -0,0 +1,109 @@
+# upper bounds in seconds of the latency histogram buckets, the last bucket holds everything slower
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+class opcodestats():
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.replies = 0
+        self.latency_total = 0
+        self.latency_max = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def snapshot(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "latency_avg": self.latency_total / self.replies if self.replies else None,
+            "latency_max": self.latency_max,
+            "histogram": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['inf'], self.histogram)),
+        }
+
+class metrics():
+    """Counters for the requests a snes sends.
+
+    Observers added with add_observer are called with a dict describing
+    every finished request: opcode, status ('ok', 'error', 'timeout' or
+    'sent' for requests without a reply), latency in seconds (None when
+    there is no reply), bytes_out, bytes_in, lock_wait and depth, the number
+    of replies outstanding when it was sent.
+    """
+    def __init__(self):
+        self.observers = []
+        self.reset()
+
+    def reset(self):
+        self.opcodes = {}
+        self.lock_wait_total = 0
+        self.lock_wait_max = 0
+        self.depth_max = 0
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        if observer in self.observers:
+            self.observers.remove(observer)
+
+    def opcode(self, opcode):
+        stats = self.opcodes.get(opcode)
+        if stats is None:
+            stats = self.opcodes[opcode] = opcodestats()
+        return stats
+
+    def sent(self, opcode, size, lock_wait, depth):
+        stats = self.opcode(opcode)
+        stats.requests += 1
+        stats.bytes_out += size
+        self.lock_wait_total += lock_wait
+        self.lock_wait_max = max(self.lock_wait_max, lock_wait)
+        self.depth_max = max(self.depth_max, depth)
+
+    def received(self, opcode, size):
+        self.opcode(opcode).bytes_in += size
+
+    def completed(self, opcode, status, latency=None, **details):
+        stats = self.opcode(opcode)
+        if status == 'error':
+            stats.errors += 1
+        elif status == 'timeout':
+            stats.timeouts += 1
+        elif latency is not None:
+            stats.replies += 1
+            stats.latency_total += latency
+            stats.latency_max = max(stats.latency_max, latency)
+            for idx, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    break
+            else:
+                idx = len(LATENCY_BUCKETS)
+            stats.histogram[idx] += 1
+
+        if self.observers:
+            event = dict(details, opcode=opcode, status=status, latency=latency)
+            for observer in list(self.observers):
+                try:
+                    observer(event)
+                except Exception as e:
+                    import logging
+                    logging.exception(e)
+
+    def snapshot(self):
+        requests = sum(stats.requests for stats in self.opcodes.values())
+        return {
+            "opcodes": dict((opcode, stats.snapshot()) for opcode, stats in self.opcodes.items()),
+            "requests": requests,
+            "bytes_out": sum(stats.bytes_out for stats in self.opcodes.values()),
+            "bytes_in": sum(stats.bytes_in for stats in self.opcodes.values()),
+            "timeouts": sum(stats.timeouts for stats in self.opcodes.values()),
+            "errors": sum(stats.errors for stats in self.opcodes.values()),
+            "lock_wait_avg": self.lock_wait_total / requests if requests else None,
+            "lock_wait_max": self.lock_wait_max,
+            "depth_max": self.depth_max,
+        }
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+
+import websockets
+
+from py2snes import WRAM_START
+
+class mockserver():
+    """An in-process stand-in for QUsb2snes, for benchmarks and development without hardware.
+
+    It serves DeviceList, Attach, Name, Info, Boot, Menu, Reset, GetAddress
+    and PutAddress (also in the SD2SNES CMD space, where arming the NMI hook
+    runs it against WRAM right away), GetFile, PutFile, List, MakeDir and Remove from an
+    in-memory 16 MB address space and file system.  Replies are delayed by
+    latency seconds without holding up the requests behind them, like a
+    link with that round-trip time, and binary replies are split into frames
+    of at most frame_size bytes.  Boot loads the file into ROM space, and
+    Info reports NO_ROM_WRITE unless rom_write is set.
+    """
+    def __init__(self, devices=('SD2SNES COM3',), latency=0, frame_size=1024, memory=None, multi_getaddress=True, rom_write=False):
+        self.devices = list(devices)
+        self.latency = latency
+        self.frame_size = frame_size
+        self.multi_getaddress = multi_getaddress
+        self.rom_write = rom_write
+        self.memory = bytearray(0x1000000)
+        if memory is not None:
+            self.memory[:len(memory)] = memory
+        self.cmd = bytearray(0x10000)
+        self.files = {}
+        self.dirs = {'': ''}
+        self.rom = None
+        self.requests = 0
+        self.server = None
+
+    async def start(self, host='localhost', port=0):
+        """Start serving and return the websocket address to connect to."""
+        self.server = await websockets.serve(self.handler, host, port, max_size=None)
+        port = self.server.sockets[0].getsockname()[1]
+        return 'ws://%s:%d' % (host, port)
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handler(self, ws, path=None):
+        replies = asyncio.Queue()
+        sender = asyncio.create_task(self.send_replies(ws, replies))
+        try:
+            await self.handle_requests(ws, replies)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            sender.cancel()
+
+    async def send_replies(self, ws, replies):
+        loop = asyncio.get_event_loop()
+        while True:
+            due, frames = await replies.get()
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            for frame in frames:
+                await ws.send(frame)
+
+    async def handle_requests(self, ws, replies):
+        loop = asyncio.get_event_loop()
+        def reply(*frames):
+            replies.put_nowait((loop.time() + self.latency, frames))
+
+        async for msg in ws:
+            if not isinstance(msg, str):
+                logging.warning('mockserver: unexpected binary frame')
+                continue
+            request = json.loads(msg)
+            self.requests += 1
+
+            opcode = request['Opcode']
+            operands = request.get('Operands') or []
+            if opcode == 'DeviceList':
+                reply(json.dumps({'Results': self.devices}))
+            elif opcode == 'Info':
+                flags = [] if self.rom_write else ['NO_ROM_WRITE']
+                reply(json.dumps({'Results': ['1.10.3', 'mockserver', self.rom or '/sd2snes/menu.bin'] + flags}))
+            elif opcode == 'Boot':
+                self.rom = operands[0]
+                data = self.files.get(operands[0].lower(), (None, b''))[1]
+                # copier headers are not part of ROM space
+                data = data[512:] if len(data) % 1024 == 512 else data
+                self.memory[:len(data)] = data
+            elif opcode in ['Attach', 'Name', 'Menu', 'Reset']:
+                pass
+            elif opcode == 'GetAddress':
+                pairs = list(zip(operands[::2], operands[1::2]))
+                if len(pairs) > 1 and not self.multi_getaddress:
+                    # like an old server, hang up on operands it does not understand
+                    await ws.close()
+                    return
+                source = self.cmd if request.get('Space') == 'CMD' else self.memory
+                data = bytearray()
+                for address, size in pairs:
+                    address, size = int(address, 16), int(size, 16)
+                    data += source[address:address + size]
+                reply(*self.frames(data))
+            elif opcode == 'PutAddress':
+                pairs = [(int(address, 16), int(size, 16)) for address, size in zip(operands[::2], operands[1::2])]
+                data = await self.recv_data(ws, sum(size for address, size in pairs))
+                pos = 0
+                target = self.cmd if request.get('Space') == 'CMD' else self.memory
+                for address, size in pairs:
+                    target[address:address + size] = data[pos:pos + size]
+                    pos += size
+                if target is self.cmd and self.cmd[0x2C00]:
+                    self.run_nmi_hook()
+            elif opcode == 'GetFile':
+                data = self.files.get(operands[0].lower(), (None, b''))[1]
+                reply(json.dumps({'Results': [hex(len(data))[2:]]}), *self.frames(data))
+            elif opcode == 'PutFile':
+                data = await self.recv_data(ws, int(operands[1], 16))
+                self.files[operands[0].lower()] = (operands[0].rsplit('/', 1)[1], bytes(data))
+            elif opcode == 'List':
+                reply(json.dumps({'Results': self.listing(operands[0])}))
+            elif opcode == 'MakeDir':
+                self.dirs[operands[0].lower().rstrip('/')] = operands[0].rstrip('/').rsplit('/', 1)[1]
+            elif opcode == 'Remove':
+                self.files.pop(operands[0].lower(), None)
+                self.dirs.pop(operands[0].lower(), None)
+            else:
+                logging.warning('mockserver: unsupported opcode %s', opcode)
+
+    def frames(self, data):
+        view = memoryview(data)
+        return [bytes(view[pos:pos + self.frame_size]) for pos in range(0, len(view), self.frame_size)]
+
+    async def recv_data(self, ws, size):
+        data = bytearray()
+        while len(data) < size:
+            data += await ws.recv()
+        return data
+
+    def listing(self, dirpath):
+        dirpath = dirpath.lower().rstrip('/')
+        results = ['0', '.', '0', '..']
+        for path, name in sorted(self.dirs.items()):
+            if path and path.rsplit('/', 1)[0] == dirpath:
+                results += ['0', name]
+        for path, (name, data) in sorted(self.files.items()):
+            if path.rsplit('/', 1)[0] == dirpath:
+                results += ['1', name]
+        return results
+
+    def run_nmi_hook(self):
+        """Run the code at $2C00 the way the SD2SNES NMI hook would, for the instructions py2snes generates."""
+        try:
+            _cpu(self).run(0x2C00)
+        except Exception as e:
+            logging.warning('mockserver: NMI hook failed: %s', e)
+
+class _cpu():
+    def __init__(self, server):
+        self.server = server
+        self.a = self.x = self.y = self.db = 0
+        self.p = 0x30
+        self.stack = []
+
+    def read(self, address):
+        bank, offset = address >> 16, address & 0xFFFF
+        if bank == 0x00 and 0x2000 <= offset < 0x3000:
+            return self.server.cmd[offset]
+        if bank in (0x7E, 0x7F):
+            return self.server.memory[WRAM_START + (bank - 0x7E) * 0x10000 + offset]
+        return 0
+
+    def write(self, address, value):
+        bank, offset = address >> 16, address & 0xFFFF
+        if bank == 0x00 and 0x2000 <= offset < 0x3000:
+            self.server.cmd[offset] = value
+        elif bank in (0x7E, 0x7F):
+            self.server.memory[WRAM_START + (bank - 0x7E) * 0x10000 + offset] = value
+
+    def operand(self, size):
+        value = int.from_bytes(bytes(self.read(self.pc + 1 + i) for i in range(size)), 'little')
+        self.pc += 1 + size
+        return value
+
+    def push(self, value, size):
+        for shift in range(size - 1, -1, -1):
+            self.stack.append((value >> (8 * shift)) & 0xFF)
+
+    def pull(self, size):
+        value = 0
+        for shift in range(size):
+            value |= self.stack.pop() << (8 * shift)
+        return value
+
+    def run(self, pc, limit=1000000):
+        self.pc = pc
+        for step in range(limit):
+            op = self.read(self.pc)
+            m = 1 if self.p & 0x20 else 2
+            x = 1 if self.p & 0x10 else 2
+            if op == 0x08: # PHP
+                self.push(self.p, 1); self.pc += 1
+            elif op == 0x28: # PLP
+                self.p = self.pull(1); self.pc += 1
+            elif op == 0xC2: # REP
+                self.p &= ~self.operand(1)
+            elif op == 0xE2: # SEP
+                self.p |= self.operand(1)
+            elif op == 0x48: # PHA
+                self.push(self.a, m); self.pc += 1
+            elif op == 0x68: # PLA
+                self.a = self.pull(m) if m == 2 else (self.a & 0xFF00) | self.pull(1); self.pc += 1
+            elif op == 0xDA: # PHX
+                self.push(self.x, x); self.pc += 1
+            elif op == 0xFA: # PLX
+                self.x = self.pull(x); self.pc += 1
+            elif op == 0x5A: # PHY
+                self.push(self.y, x); self.pc += 1
+            elif op == 0x7A: # PLY
+                self.y = self.pull(x); self.pc += 1
+            elif op == 0x8B: # PHB
+                self.push(self.db, 1); self.pc += 1
+            elif op == 0xAB: # PLB
+                self.db = self.pull(1); self.pc += 1
+            elif op == 0xEB: # XBA
+                self.a = ((self.a & 0xFF) << 8) | (self.a >> 8); self.pc += 1
+            elif op == 0xA9: # LDA #
+                self.a = self.operand(m) if m == 2 else (self.a & 0xFF00) | self.operand(1)
+            elif op == 0xA2: # LDX #
+                self.x = self.operand(x)
+            elif op == 0xA0: # LDY #
+                self.y = self.operand(x)
+            elif op == 0x8F: # STA.l
+                address = self.operand(3)
+                self.write(address, self.a & 0xFF)
+                if m == 2:
+                    self.write(address + 1, self.a >> 8)
+            elif op == 0x54: # MVN
+                dst, src = self.read(self.pc + 1), self.read(self.pc + 2)
+                self.pc += 3
+                while True:
+                    self.write((dst << 16) | self.y, self.read((src << 16) | self.x))
+                    self.x = (self.x + 1) & 0xFFFF
+                    self.y = (self.y + 1) & 0xFFFF
+                    self.a = (self.a - 1) & 0xFFFF
+                    if self.a == 0xFFFF:
+                        break
+                self.db = dst
+            elif op == 0x6C: # JMP ($FFEA), back to the game's NMI handler
+                return
+            else:
+                raise Exception('unsupported opcode %02X at %06X' % (op, self.pc))
+        raise Exception('NMI hook did not return')
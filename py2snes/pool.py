@@ -0,0 +1,75 @@
+import asyncio
+
+import py2snes
+
+class pool():
+    """Keeps one attached snes connection per device across several QUsb2snes hosts.
+
+    Devices are keyed by (host, device).  The fan-out methods run the same
+    operation on every device concurrently with a per-device timeout and
+    return a dict of results, holding the exception instead for devices that
+    failed or timed out so one slow console does not hold up the rest.  A
+    write that times out is still sent whole, only the wait for it ends, so
+    the connection stays in step with the server.
+    """
+    def __init__(self, hosts=('ws://localhost:8080',), timeout=5):
+        self.hosts = list(hosts)
+        self.timeout = timeout
+        self.devices = {}
+
+    async def discover(self):
+        """Attach to every device listed by the hosts that is not attached yet, returning all device keys."""
+        await asyncio.gather(*[self._discover(host) for host in self.hosts])
+        return list(self.devices)
+
+    async def _discover(self, host):
+        probe = py2snes.snes()
+        await probe.connect(host)
+        try:
+            devices = await probe.DeviceList()
+        finally:
+            await probe.close()
+
+        for device in devices or []:
+            key = (host, device)
+            if key in self.devices and self.devices[key].state == py2snes.SNES_ATTACHED:
+                continue
+            # QUsb2snes attaches one device per websocket
+            conn = py2snes.snes()
+            await conn.connect(host)
+            await conn.Attach(device)
+            if conn.state == py2snes.SNES_ATTACHED:
+                self.devices[key] = conn
+            else:
+                await conn.close()
+
+    def prune(self):
+        """Forget devices whose connection has dropped, so the next discover() attaches them again."""
+        for key, conn in list(self.devices.items()):
+            if conn.state != py2snes.SNES_ATTACHED:
+                del self.devices[key]
+
+    async def close(self):
+        await asyncio.gather(*[conn.close() for conn in self.devices.values()])
+        self.devices.clear()
+
+    async def each(self, fn, timeout=None):
+        """Call fn(snes) for every device concurrently, returning {key: result or exception}."""
+        keys = list(self.devices)
+        results = await asyncio.gather(
+            *[asyncio.wait_for(fn(self.devices[key]), timeout or self.timeout) for key in keys],
+            return_exceptions=True
+        )
+        return dict(zip(keys, results))
+
+    async def Info(self, timeout=None):
+        return await self.each(lambda conn: conn.Info(), timeout)
+
+    async def GetAddress(self, address, size, timeout=None):
+        return await self.each(lambda conn: conn.GetAddress(address, size), timeout)
+
+    async def GetAddresses(self, regions, timeout=None):
+        return await self.each(lambda conn: conn.GetAddresses(regions), timeout)
+
+    async def PutAddress(self, write_list, timeout=None):
+        return await self.each(lambda conn: conn.PutAddress(write_list), timeout)
@@ -0,0 +1,261 @@
+import asyncio
+import bisect
+import re
+import struct
+import time
+import zlib
+
+import aiofiles
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from py2snes import usb2snesException
+from py2snes.sampler import sampler
+
+# magic, version, compression, region count, wall clock start time, sample rate
+_HEADER = struct.Struct('<4sHBHdd')
+_REGION = struct.Struct('<II')
+# record type, seconds since the start, payload size
+_RECORD = struct.Struct('<BdI')
+# offset into the snapshot and length of a changed run
+_RUN = struct.Struct('<IH')
+# keyframe time and file offset
+_INDEX = struct.Struct('<dQ')
+# index offset, keyframe count, magic
+_TRAILER = struct.Struct('<QI4s')
+_MAGIC = b'P2SR'
+_INDEX_MAGIC = b'P2SI'
+_VERSION = 1
+
+_KEYFRAME = 0
+_DELTA = 1
+_INDEXED = 2
+
+_COMPRESSION = {None: 0, 'zlib': 1, 'lz4': 2}
+
+# changed bytes, bridging unchanged gaps shorter than a run header
+_CHANGED = re.compile(rb'[^\x00]+(?:\x00{1,%d}[^\x00]+)*' % _RUN.size)
+
+def _compress(compression, payload):
+    if compression == 1:
+        return zlib.compress(payload)
+    if compression == 2:
+        return lz4.frame.compress(payload)
+    return payload
+
+def _decompress(compression, payload):
+    if compression == 1:
+        return zlib.decompress(payload)
+    if compression == 2:
+        if lz4 is None:
+            raise usb2snesException('This log is lz4 compressed, install lz4 to read it')
+        return lz4.frame.decompress(payload)
+    return payload
+
+def _delta(previous, current):
+    """Encode the runs of current that differ from previous."""
+    size = len(current)
+    diff = (int.from_bytes(previous, 'little') ^ int.from_bytes(current, 'little')).to_bytes(size, 'little')
+    payload = bytearray()
+    view = memoryview(current)
+    for match in _CHANGED.finditer(diff):
+        start, end = match.span()
+        # runs longer than a run header can describe are split
+        for pos in range(start, end, 0xFFFF):
+            length = min(end - pos, 0xFFFF)
+            payload += _RUN.pack(pos, length)
+            payload += view[pos:pos + length]
+    return payload
+
+def _apply(snapshot, payload):
+    view = memoryview(payload)
+    pos = 0
+    while pos < len(view):
+        offset, length = _RUN.unpack_from(view, pos)
+        pos += _RUN.size
+        snapshot[offset:offset + length] = view[pos:pos + length]
+        pos += length
+
+class recorder():
+    """Records regions of memory to a compact log on disk.
+
+    Regions are sampled at rate per second with a sampler and every sample
+    is written as the runs of bytes that changed since the previous one.  A
+    full keyframe is written every keyframe_interval seconds so a replay can
+    seek without decoding the whole run.  Records are compressed with zlib
+    or lz4 when compression is 'zlib' or 'lz4', and an index of the
+    keyframes is appended when the recording stops.
+    """
+    def __init__(self, snes, path, regions, rate=30, keyframe_interval=10, compression=None):
+        if compression not in _COMPRESSION:
+            raise ValueError('Unsupported compression %s' % compression)
+        if compression == 'lz4' and lz4 is None:
+            raise usb2snesException('lz4 compression needs the lz4 package')
+        self.snes = snes
+        self.path = path
+        self.regions = list(regions)
+        self.rate = rate
+        self.keyframe_interval = keyframe_interval
+        self.compression = _COMPRESSION[compression]
+        self.sampler = None
+        self.writer = None
+        self.outfile = None
+        self.previous = None
+        self.keyframe = None
+        self.index = []
+        self.offset = 0
+        self.start_time = None
+
+        self.samples = 0
+        self.keyframes = 0
+        self.bytes = 0
+
+    async def start(self):
+        self.outfile = await aiofiles.open(self.path, 'wb')
+        header = _HEADER.pack(_MAGIC, _VERSION, self.compression, len(self.regions), time.time(), self.rate)
+        header += b''.join(_REGION.pack(address, size) for address, size in self.regions)
+        await self._write(header)
+
+        self.start_time = time.monotonic()
+        self.sampler = sampler(self.snes, self.regions, rate=self.rate)
+        self.writer = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop sampling, write what was queued and the index, and close the log."""
+        if self.sampler is None:
+            return
+        await self.sampler.stop()
+        await self.writer
+        self.sampler = None
+        self.writer = None
+
+        # the index is a record too, so a log missing its trailer still scans cleanly
+        index = b''.join(_INDEX.pack(timestamp, offset) for timestamp, offset in self.index)
+        await self._write(_RECORD.pack(_INDEXED, 0, len(index)))
+        await self._write(index + _TRAILER.pack(self.offset, len(self.index), _INDEX_MAGIC))
+        await self.outfile.close()
+        self.outfile = None
+
+    async def run(self):
+        async for item in self.sampler:
+            await self.record(item.timestamp - self.start_time, b''.join(item.data))
+
+    async def record(self, timestamp, snapshot):
+        """Append a snapshot of the regions, laid out back to back, taken timestamp seconds into the recording."""
+        if self.keyframe is None or timestamp - self.keyframe >= self.keyframe_interval:
+            self.index.append((timestamp, self.offset))
+            self.keyframe = timestamp
+            self.keyframes += 1
+            kind, payload = _KEYFRAME, snapshot
+        else:
+            kind, payload = _DELTA, _delta(self.previous, snapshot)
+        self.previous = snapshot
+        self.samples += 1
+
+        payload = _compress(self.compression, payload)
+        await self._write(_RECORD.pack(kind, timestamp, len(payload)) + payload)
+
+    async def _write(self, data):
+        await self.outfile.write(data)
+        self.offset += len(data)
+        self.bytes += len(data)
+
+class replay():
+    """Reads a log written by recorder.
+
+    seek() rebuilds the regions as they were at any time of the recording
+    from the nearest keyframe before it, iterating yields every sample in
+    order as (timestamp, list of bytes per region).  Logs whose recording
+    was interrupted have no index and are scanned once to rebuild it.
+    """
+    def __init__(self, path):
+        self.infile = open(path, 'rb')
+        magic, version, self.compression, count, self.start_time, self.rate = _HEADER.unpack(self.infile.read(_HEADER.size))
+        if magic != _MAGIC or version != _VERSION:
+            self.infile.close()
+            raise usb2snesException('%s is not a py2snes recording' % path)
+        self.regions = [_REGION.unpack(self.infile.read(_REGION.size)) for idx in range(count)]
+        self.size = sum(size for address, size in self.regions)
+        self.data_start = self.infile.tell()
+        self.data_end, self.index = self._load_index()
+        self.times = [timestamp for timestamp, offset in self.index]
+
+    def _load_index(self):
+        end = self.infile.seek(0, 2)
+        if end - self.data_start >= _TRAILER.size:
+            self.infile.seek(end - _TRAILER.size)
+            offset, count, magic = _TRAILER.unpack(self.infile.read(_TRAILER.size))
+            if magic == _INDEX_MAGIC and offset + count * _INDEX.size + _TRAILER.size == end:
+                self.infile.seek(offset)
+                data = self.infile.read(count * _INDEX.size)
+                return offset - _RECORD.size, [_INDEX.unpack_from(data, pos) for pos in range(0, len(data), _INDEX.size)]
+
+        index = []
+        pos = self.data_start
+        self.infile.seek(pos)
+        while True:
+            header = self.infile.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                break
+            kind, timestamp, size = _RECORD.unpack(header)
+            if kind not in (_KEYFRAME, _DELTA) or len(self.infile.read(size)) < size:
+                break
+            if kind == _KEYFRAME:
+                index.append((timestamp, pos))
+            pos += _RECORD.size + size
+        return pos, index
+
+    def _records(self, offset):
+        self.infile.seek(offset)
+        while offset < self.data_end:
+            kind, timestamp, size = _RECORD.unpack(self.infile.read(_RECORD.size))
+            payload = _decompress(self.compression, self.infile.read(size))
+            offset += _RECORD.size + size
+            yield kind, timestamp, payload
+
+    def _split(self, snapshot):
+        results = []
+        pos = 0
+        for address, size in self.regions:
+            results.append(bytes(snapshot[pos:pos + size]))
+            pos += size
+        return results
+
+    def __iter__(self):
+        snapshot = bytearray(self.size)
+        for kind, timestamp, payload in self._records(self.data_start):
+            if kind == _KEYFRAME:
+                snapshot[:] = payload
+            else:
+                _apply(snapshot, payload)
+            yield timestamp, self._split(snapshot)
+
+    def seek(self, timestamp):
+        """Return (timestamp, list of bytes per region) for the last sample at or before timestamp, or None if there is none."""
+        idx = bisect.bisect_right(self.times, timestamp) - 1
+        if idx < 0:
+            return None
+
+        snapshot = bytearray(self.size)
+        found = None
+        for kind, sample_time, payload in self._records(self.index[idx][1]):
+            if sample_time > timestamp:
+                break
+            if kind == _KEYFRAME:
+                snapshot[:] = payload
+            else:
+                _apply(snapshot, payload)
+            found = sample_time
+        return found, self._split(snapshot)
+
+    def close(self):
+        self.infile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
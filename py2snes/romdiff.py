@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+from py2snes import ROM_START, usb2snesException
+
+ROMDIFF_BLOCK_SIZE = 1024
+# seconds to wait for a booted ROM to show up in Info
+BOOT_TIMEOUT = 10
+# blocks spread over the ROM read back to check the SD card copy is still base
+ROMDIFF_VERIFY_BLOCKS = 16
+
+def _strip_header(data):
+    # copier headers are not part of ROM space
+    return data[512:] if len(data) % 1024 == 512 else data
+
+def _seed_path(dstfile):
+    # uploads that are not base go next to it, so the SD card keeps base at dstfile
+    dirpath, filename = dstfile.rsplit('/', 1)
+    stem, dot, ext = filename.rpartition('.')
+    return '%s/%s.seed.%s' % (dirpath, stem, ext) if dot else '%s/%s.seed' % (dirpath, filename)
+
+def _sample_blocks(size, block_size, count):
+    step = max(size // count, block_size)
+    offsets = set(range(0, size, step))
+    offsets.add(max(size - block_size, 0))
+    return [(offset, min(block_size, size - offset)) for offset in sorted(offsets)]
+
+def _changed_blocks(base, rom, block_size):
+    """Return the (offset, data) runs of rom whose blocks differ from base."""
+    base = memoryview(base)
+    rom = memoryview(rom)
+    runs = []
+    for pos in range(0, len(rom), block_size):
+        if rom[pos:pos + block_size] != base[pos:pos + block_size]:
+            if runs and runs[-1][1] == pos:
+                runs[-1][1] = pos + block_size
+            else:
+                runs.append([pos, pos + block_size])
+    return [(start, bytes(rom[start:end])) for start, end in runs]
+
+async def _booted(snes, romfile, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        info = await snes.Info()
+        if info is not None and (info['romrunning'] or '').lstrip('/').lower() == romfile.lstrip('/').lower():
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+async def upload(snes, srcfile, dstfile, base=None, block_size=ROMDIFF_BLOCK_SIZE, progress=None):
+    """Load the ROM srcfile on the console from dstfile, sending only what differs from base when possible.
+
+    base is a local copy of the ROM stored at dstfile on the SD card, for
+    instance the unmodified game a randomizer seed was made from.  When it
+    has the same size as srcfile and the device allows ROM writes, base is
+    uploaded to dstfile if it is not there yet, dstfile is booted, a sample
+    of its blocks is read back to check it really is base (uploading base
+    again if not), and the blocks of block_size bytes that differ are
+    written to ROM space with PutAddress, read back to check them, and the
+    console is reset to start the patched game.  The SD card keeps base.
+
+    Otherwise srcfile is uploaded with PutFile and booted: to dstfile
+    without base, and with base to a .seed file next to dstfile, so base is
+    never overwritten.
+
+    Returns a dict with the mode used, 'patch' or 'upload', the file booted,
+    the number of bytes sent and the elapsed seconds.
+    """
+    start = time.monotonic()
+    with open(srcfile, 'rb') as infile:
+        rom = infile.read()
+
+    if base is not None:
+        with open(base, 'rb') as infile:
+            base_rom = infile.read()
+        runs = await _patch(snes, _strip_header(rom), _strip_header(base_rom), base, dstfile, block_size)
+        if runs is not None:
+            return {
+                "mode": "patch",
+                "file": dstfile,
+                "bytes": sum(len(data) for address, data in runs),
+                "seconds": time.monotonic() - start,
+            }
+        dstfile = _seed_path(dstfile)
+
+    if not await snes.PutFile(srcfile, dstfile, progress=progress):
+        raise usb2snesException('Could not upload %s' % srcfile)
+    await snes.Boot(dstfile)
+    return {
+        "mode": "upload",
+        "file": dstfile,
+        "bytes": len(rom),
+        "seconds": time.monotonic() - start,
+    }
+
+async def _patch(snes, rom, base_rom, basefile, dstfile, block_size):
+    if len(rom) != len(base_rom):
+        return None
+
+    info = await snes.Info()
+    if info is None or 'NO_ROM_WRITE' in (info['flag1'], info['flag2']):
+        return None
+
+    dirpath, filename = dstfile.rstrip('/').rsplit('/', 1)
+    try:
+        listing = await snes.List(dirpath or '/')
+    except FileNotFoundError:
+        listing = []
+    if listing is None:
+        return None
+    missing = filename.lower() not in [d['filename'].lower() for d in listing]
+
+    samples = _sample_blocks(len(base_rom), block_size, ROMDIFF_VERIFY_BLOCKS)
+    for attempt in range(2):
+        if missing and not await snes.PutFile(basefile, dstfile):
+            return None
+        # booting reloads base from the SD card, whatever was patched in before
+        await snes.Boot(dstfile)
+        if not await _booted(snes, dstfile, BOOT_TIMEOUT):
+            return None
+        read = await snes.GetAddresses([(ROM_START + offset, size) for offset, size in samples])
+        if read is None:
+            return None
+        if read == [base_rom[offset:offset + size] for offset, size in samples]:
+            break
+        # the SD card copy is not base, put base back and boot it again
+        missing = True
+    else:
+        return None
+
+    runs = [(ROM_START + offset, data) for offset, data in _changed_blocks(base_rom, rom, block_size)]
+    if runs:
+        if not await snes.PutAddress(runs):
+            return None
+        # writes are not acknowledged, the read back confirms they landed
+        if await snes.GetAddresses([(address, len(data)) for address, data in runs]) != [data for address, data in runs]:
+            return None
+    await snes.Reset()
+    return runs
@@ -0,0 +1,132 @@
+import asyncio
+import collections
+import time
+
+from py2snes import _poller
+
+# NTSC frame rate
+FRAME_RATE = 60.0988
+
+class sample(collections.namedtuple('sample', ['timestamp', 'frame', 'data'])):
+    """A (timestamp, frame, data) tuple, with the monotonic send and receive times as the sent and received attributes.
+
+    timestamp is the midpoint of the two, the best estimate of when the
+    console was read.  frame is the frame counter value or None, data is a
+    list of bytes, one per region.
+    """
+
+class sampler(_poller):
+    """Reads regions at a fixed rate and delivers timestamped samples as an async iterator.
+
+    Reads are scheduled on a fixed grid of the monotonic clock, so they do
+    not drift with the time a read takes.  The task sleeps until spin
+    seconds before a read is due and yields to the loop until it is, which
+    trims the scheduling jitter of a plain sleep.  A read still sent more
+    than late seconds after its slot counts as late; slots missed entirely
+    because a read overran, or whose read failed, count as dropped.
+
+    With frame_counter, the address of a frame counter of frame_size bytes,
+    the counter is read in the same batch as the regions.  A sample of a
+    frame that was already delivered is discarded as a duplicate and the
+    grid is pushed back by a quarter period, which walks the reads away
+    from frame boundaries; frames the counter skipped are counted too.
+
+    Samples queue up to maxsize, beyond that the oldest are discarded.
+    """
+    def __init__(self, snes, regions, rate=FRAME_RATE, frame_counter=None, frame_size=1, maxsize=600, late=None, spin=0.002):
+        self.snes = snes
+        self.regions = list(regions)
+        self.period = 1 / rate
+        self.frame_counter = frame_counter
+        self.frame_size = frame_size
+        self.late_threshold = self.period / 2 if late is None else late
+        self.spin = spin
+        self.queue = asyncio.Queue(maxsize)
+        self.task = None
+        self.frame = None
+
+        self.samples = 0
+        self.late = 0
+        self.dropped = 0
+        self.discarded = 0
+        self.duplicates = 0
+        self.frames_missed = 0
+
+    async def stop(self):
+        if self.task is not None:
+            await super().stop()
+            self._put(None)
+
+    def stats(self):
+        return {
+            "samples": self.samples,
+            "late": self.late,
+            "dropped": self.dropped,
+            "discarded": self.discarded,
+            "duplicates": self.duplicates,
+            "frames_missed": self.frames_missed,
+        }
+
+    def __aiter__(self):
+        self.start()
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    def _put(self, item):
+        if self.queue.full():
+            self.queue.get_nowait()
+            if item is not None:
+                self.discarded += 1
+        self.queue.put_nowait(item)
+
+    async def _wait(self, due):
+        delay = due - self.spin - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        while time.monotonic() < due:
+            await asyncio.sleep(0)
+
+    async def run(self):
+        regions = self.regions
+        if self.frame_counter is not None:
+            regions = regions + [(self.frame_counter, self.frame_size)]
+
+        due = time.monotonic()
+        while True:
+            await self._wait(due)
+            sent = time.monotonic()
+            if sent - due > self.late_threshold:
+                self.late += 1
+            results = await self.snes.GetAddresses(regions)
+            received = time.monotonic()
+
+            if results is None:
+                self.dropped += 1
+            else:
+                frame = None
+                if self.frame_counter is not None:
+                    frame = int.from_bytes(results.pop(), 'little')
+                if frame is not None and frame == self.frame:
+                    self.duplicates += 1
+                    due += self.period / 4
+                else:
+                    if frame is not None and self.frame is not None:
+                        self.frames_missed += max((frame - self.frame) % (1 << (8 * self.frame_size)) - 1, 0)
+                    self.frame = frame
+                    item = sample((sent + received) / 2, frame, results)
+                    item.sent = sent
+                    item.received = received
+                    self.samples += 1
+                    self._put(item)
+
+            due += self.period
+            now = time.monotonic()
+            if due < now:
+                skipped = int((now - due) / self.period) + 1
+                self.dropped += skipped
+                due += skipped * self.period
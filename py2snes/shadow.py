@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+from py2snes import WRAM_START, WRAM_SIZE, SRAM_START, _merge_regions, _merge_writes
+
+class _region():
+    def __init__(self, start, size, chunk_size):
+        self.start = start
+        self.size = size
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.updated = [None] * -(-size // chunk_size)
+        self.loading = {}
+
+class shadowmemory():
+    """A local copy of WRAM and the SRAM window shared by every reader in the process.
+
+    Memory is refreshed in chunk_size chunks.  read() serves bytes from the
+    local copy when their chunks are fresher than max_age seconds and
+    otherwise refreshes the stale chunks, reading each contiguous run of
+    them straight into the copy with pipelined GetAddress requests.  Readers
+    needing a chunk that is already being refreshed wait for that read
+    instead of sending their own.  write() updates the copy and records the
+    bytes as dirty until flush() sends them with one minimal PutAddress.
+    """
+    def __init__(self, snes, sram_size=0x8000, chunk_size=0x400, regions=None):
+        if regions is None:
+            regions = [(WRAM_START, WRAM_SIZE), (SRAM_START, sram_size)]
+        self.snes = snes
+        self.chunk_size = chunk_size
+        self.regions = [_region(start, size, chunk_size) for start, size in regions]
+        self.writes = []
+
+    def _find(self, address, size):
+        for region in self.regions:
+            if region.start <= address and address + size <= region.start + region.size:
+                return region
+        raise ValueError('%s (%d bytes) is outside the shadowed memory' % (hex(address), size))
+
+    async def refresh(self, address=None, size=None, max_age=None):
+        """Refresh the chunks covering a range, or all memory, that are older than max_age; returns whether every read succeeded."""
+        if address is None:
+            targets = [(region, 0, region.size) for region in self.regions]
+        else:
+            region = self._find(address, size)
+            targets = [(region, address - region.start, size)]
+
+        now = time.monotonic()
+        waits = []
+        reads = []
+        for region, offset, size in targets:
+            stale = []
+            for chunk in range(offset // self.chunk_size, (offset + size - 1) // self.chunk_size + 1):
+                if chunk in region.loading:
+                    waits.append(region.loading[chunk])
+                elif max_age is None or region.updated[chunk] is None or now - region.updated[chunk] > max_age:
+                    stale.append(chunk)
+
+            for first, last in _merge_regions((chunk, 1) for chunk in stale):
+                future = asyncio.get_event_loop().create_future()
+                for chunk in range(first, last):
+                    region.loading[chunk] = future
+                reads.append((region, first, last, future))
+
+        results = []
+        try:
+            results = await asyncio.gather(*[
+                self.snes.GetAddressInto(
+                    region.start + first * self.chunk_size,
+                    region.view[first * self.chunk_size:min(last * self.chunk_size, region.size)]
+                ) for region, first, last, future in reads
+            ])
+        finally:
+            # settle every read even on failure, other readers may be waiting on them
+            for idx, (region, first, last, future) in enumerate(reads):
+                ok = idx < len(results) and results[idx] is not None
+                for chunk in range(first, last):
+                    del region.loading[chunk]
+                    if ok:
+                        region.updated[chunk] = now
+                future.set_result(ok)
+        if reads:
+            # the reads land straight in the copy, put back what has not been flushed yet
+            for address, data in self.writes:
+                region = self._find(address, len(data))
+                region.data[address - region.start:address - region.start + len(data)] = data
+
+        return all(result is not None for result in results) and all(await asyncio.gather(*set(waits)))
+
+    async def read(self, address, size, max_age=1/60):
+        """Return size bytes at address from the local copy, refreshing chunks older than max_age seconds first."""
+        if not await self.refresh(address, size, max_age):
+            return None
+        region = self._find(address, size)
+        return bytes(region.view[address - region.start:address - region.start + size])
+
+    def write(self, address, data):
+        region = self._find(address, len(data))
+        region.data[address - region.start:address - region.start + len(data)] = data
+        self.writes.append((address, bytes(data)))
+
+    def dirty(self):
+        """Return the (address, size) ranges written locally and not flushed yet."""
+        return [(start, end - start) for start, end in _merge_regions((address, len(data)) for address, data in self.writes)]
+
+    async def flush(self):
+        """Send every dirty range to the console with one PutAddress, returning whether it succeeded."""
+        if not self.writes:
+            return True
+        writes, self.writes = self.writes, []
+        if not await self.snes.PutAddress(_merge_writes(writes)):
+            self.writes = writes + self.writes
+            return False
+        return True
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+from py2snes import _next_due, _poller, usb2snesException
+
+# magic, version, slot count, region count, snapshot size
+_HEADER = struct.Struct('<4sHHII')
+_REGION = struct.Struct('<II')
+_SEQUENCE = struct.Struct('<Q')
+# sequence and timestamp written before the snapshot, the sequence is repeated after it
+_SLOT = struct.Struct('<Qd')
+_MAGIC = b'P2SN'
+_VERSION = 1
+
+# blocks created by publishers in this process, which the resource tracker must keep tracking
+_published = set()
+
+class publisher(_poller):
+    """Polls regions on one snes and publishes them to shared memory for other processes.
+
+    Every poll reads all regions in a single GetAddresses call and writes
+    them back to back into the next slot of a ring in a shared memory block,
+    then bumps the sequence counter in its header.  Any number of
+    subscribers can open the block by name and read the latest snapshot
+    without a connection of their own.
+    """
+    def __init__(self, snes, regions, name=None, interval=1/60, slots=4):
+        self.snes = snes
+        self.regions = list(regions)
+        self.interval = interval
+        self.slots = slots
+        self.size = sum(size for address, size in self.regions)
+        self.sequence = 0
+        self.task = None
+
+        self.table = _HEADER.size + _REGION.size * len(self.regions)
+        self.slot_size = _SLOT.size + self.size + _SEQUENCE.size
+        self.memory = shared_memory.SharedMemory(name=name, create=True, size=self.table + _SEQUENCE.size + self.slot_size * slots)
+        self.name = self.memory.name
+        _published.add(self.name)
+        _HEADER.pack_into(self.memory.buf, 0, _MAGIC, _VERSION, slots, len(self.regions), self.size)
+        for idx, (address, size) in enumerate(self.regions):
+            _REGION.pack_into(self.memory.buf, _HEADER.size + _REGION.size * idx, address, size)
+        _SEQUENCE.pack_into(self.memory.buf, self.table, 0)
+
+    def publish(self, results):
+        """Write a list of bytes, one per region, as the next snapshot."""
+        sequence = self.sequence + 1
+        pos = self.table + _SEQUENCE.size + self.slot_size * (sequence % self.slots)
+        buf = self.memory.buf
+        # readers check the sequence on both sides of the snapshot to catch a torn copy
+        _SLOT.pack_into(buf, pos, sequence, time.time())
+        offset = pos + _SLOT.size
+        for data in results:
+            buf[offset:offset + len(data)] = data
+            offset += len(data)
+        _SEQUENCE.pack_into(buf, pos + _SLOT.size + self.size, sequence)
+        _SEQUENCE.pack_into(buf, self.table, sequence)
+        self.sequence = sequence
+
+    async def poll(self):
+        results = await self.snes.GetAddresses(self.regions)
+        if results is None:
+            return False
+        self.publish(results)
+        return True
+
+    async def run(self):
+        due = time.monotonic()
+        while True:
+            await self.poll()
+            due = _next_due(due, self.interval, time.monotonic())
+            await asyncio.sleep(due - time.monotonic())
+
+    def close(self):
+        """Release and remove the shared memory block, subscribers keep what they have mapped."""
+        self.memory.close()
+        self.memory.unlink()
+        _published.discard(self.name)
+
+class subscriber():
+    """Reads the snapshots a publisher writes, from any process, given the block's name."""
+    def __init__(self, name):
+        try:
+            self.memory = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before 3.13 attaching registers the block too, and the tracker would unlink it when this process exits
+            self.memory = shared_memory.SharedMemory(name=name)
+            if os.name != 'nt' and self.memory.name not in _published:
+                resource_tracker.unregister(self.memory._name, 'shared_memory')
+
+        magic, version, self.slots, count, self.size = _HEADER.unpack_from(self.memory.buf, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self.memory.close()
+            raise usb2snesException('%s is not a py2snes snapshot block' % name)
+        self.regions = [_REGION.unpack_from(self.memory.buf, _HEADER.size + _REGION.size * idx) for idx in range(count)]
+        self.table = _HEADER.size + _REGION.size * count
+        self.slot_size = _SLOT.size + self.size + _SEQUENCE.size
+        self.last = 0
+
+    @property
+    def sequence(self):
+        """The sequence number of the latest snapshot, 0 until the first one is published."""
+        return _SEQUENCE.unpack_from(self.memory.buf, self.table)[0]
+
+    def read(self):
+        """Return (sequence, timestamp, list of bytes per region) for the latest snapshot, or None before the first one."""
+        buf = self.memory.buf
+        while True:
+            sequence = self.sequence
+            if sequence == 0:
+                return None
+            pos = self.table + _SEQUENCE.size + self.slot_size * (sequence % self.slots)
+            after = _SEQUENCE.unpack_from(buf, pos + _SLOT.size + self.size)[0]
+            data = bytes(buf[pos + _SLOT.size:pos + _SLOT.size + self.size])
+            before, timestamp = _SLOT.unpack_from(buf, pos)
+            if before == after == sequence:
+                break
+            # the publisher lapped the ring while copying, take the newer snapshot
+
+        results = []
+        offset = 0
+        for address, size in self.regions:
+            results.append(data[offset:offset + size])
+            offset += size
+        self.last = sequence
+        return sequence, timestamp, results
+
+    def wait(self, sequence=None, timeout=None, interval=0.001):
+        """Block until a snapshot newer than sequence (the last one read by default) is published, then read it.
+
+        Returns None on timeout.
+        """
+        if sequence is None:
+            sequence = self.last
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.sequence <= sequence:
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(interval)
+        return self.read()
+
+    def close(self):
+        self.memory.close()
@@ -0,0 +1,104 @@
+import asyncio
+import inspect
+import threading
+
+from py2snes import snes
+
+class _futures():
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            return self.client.submit(name, *args, **kwargs)
+        return method
+
+class threadedsnes():
+    """A blocking snes for synchronous code, backed by an event loop in a background thread.
+
+    The snes lives on one persistent loop, so calls from any thread share its
+    connection and pipelining.  Every snes method is available with the same
+    arguments: s.GetAddress(address, size) blocks until the result is there,
+    s.futures.GetAddress(address, size) returns a concurrent.futures.Future
+    right away, and batch() runs a list of calls concurrently, as one
+    pipelined burst.  Async iterators, like the one GetFileStream returns,
+    come back as plain iterators.  call() runs any coroutine function taking
+    the snes, such as filesync.sync or romdiff.upload, on the loop.
+    Callbacks passed to methods run on the loop thread.
+    """
+    def __init__(self, max_inflight=8, reconnect=False):
+        self.snes = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name='py2snes', daemon=True)
+        self.thread.start()
+        self.futures = _futures(self)
+        # asyncio primitives created in snes.__init__ must belong to the loop
+        self.snes = asyncio.run_coroutine_threadsafe(self._create(max_inflight, reconnect), self.loop).result()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _create(self, max_inflight, reconnect):
+        return snes(max_inflight=max_inflight, reconnect=reconnect)
+
+    async def _invoke(self, fn, args, kwargs):
+        result = fn(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        if hasattr(result, '__anext__'):
+            return self._iterate(result)
+        return result
+
+    def _iterate(self, iterator):
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(iterator.__anext__(), self.loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            # an iterator left early still holds its request, closing it lets it clean up
+            if hasattr(iterator, 'aclose') and self.loop.is_running():
+                asyncio.run_coroutine_threadsafe(iterator.aclose(), self.loop).result()
+
+    def submit(self, name, *args, **kwargs):
+        """Call the snes method name on the loop, returning a concurrent.futures.Future of its result."""
+        return asyncio.run_coroutine_threadsafe(self._invoke(getattr(self.snes, name), args, kwargs), self.loop)
+
+    def batch(self, calls):
+        """Run (name, args) or (name, args, kwargs) calls concurrently and return their results in order.
+
+        They are started together, so reads go out pipelined instead of
+        waiting on each other's round-trips.
+        """
+        async def run():
+            return await asyncio.gather(*[self._invoke(getattr(self.snes, call[0]), call[1], call[2] if len(call) > 2 else {}) for call in calls])
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn(snes, *args, **kwargs) on the loop, awaiting it if it is a coroutine, and return its result."""
+        return asyncio.run_coroutine_threadsafe(self._invoke(fn, (self.snes,) + args, kwargs), self.loop).result()
+
+    def __getattr__(self, name):
+        attr = getattr(self.snes, name)
+        if not callable(attr):
+            return attr
+        def method(*args, **kwargs):
+            return self.submit(name, *args, **kwargs).result()
+        return method
+
+    def close(self):
+        """Close the connection and stop the loop thread."""
+        if not self.loop.is_running():
+            return
+        self.call(lambda s: s.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
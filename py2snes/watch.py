@@ -0,0 +1,84 @@
+import asyncio
+import inspect
+import logging
+import time
+
+from py2snes import _next_due, _poller
+
+class watch():
+    def __init__(self, address, size, callback, interval):
+        self.address = address
+        self.size = size
+        self.callback = callback
+        self.interval = interval
+        self.data = None
+        self.due = 0
+
+class watcher(_poller):
+    """Polls registered address ranges on a snes and calls back when they change.
+
+    Every pass reads all watches that are due in a single GetAddresses call,
+    so watches sharing a rate share a request.  Callbacks are called with
+    (address, data, changes), where changes is a list of (address, old, new)
+    tuples for the bytes that differ from the previous read; old is None for
+    the first read of a watch.
+    """
+    def __init__(self, snes):
+        self.snes = snes
+        self.watches = []
+        self.task = None
+
+    def add(self, address, size, callback, interval=1/60):
+        w = watch(address, size, callback, interval)
+        self.watches.append(w)
+        return w
+
+    def remove(self, w):
+        if w in self.watches:
+            self.watches.remove(w)
+
+    async def poll(self):
+        now = time.monotonic()
+        due = [w for w in self.watches if w.due <= now]
+        if not due:
+            return True
+
+        results = await self.snes.GetAddresses([(w.address, w.size) for w in due])
+        if results is None:
+            return False
+
+        for w, data in zip(due, results):
+            w.due = _next_due(w.due, w.interval, now)
+            if data == w.data:
+                continue
+
+            if w.data is None:
+                changes = [(w.address + i, None, new) for i, new in enumerate(data)]
+            else:
+                changes = [(w.address + i, old, new) for i, (old, new) in enumerate(zip(w.data, data)) if old != new]
+            w.data = data
+            try:
+                result = w.callback(w.address, data, changes)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logging.exception(e)
+        return True
+
+    async def run(self):
+        while True:
+            if not self.watches:
+                await asyncio.sleep(1/60)
+                continue
+
+            if not await self.poll():
+                # not attached or the read failed, try again at the fastest rate
+                await asyncio.sleep(min((w.interval for w in self.watches), default=1/60))
+                continue
+
+            # a callback may have removed the last watch
+            if not self.watches:
+                continue
+            delay = min(w.due for w in self.watches) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)